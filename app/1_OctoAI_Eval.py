@@ -1,30 +1,87 @@
 import streamlit as st
-from octoai.client import Client
 from pathlib import Path
 from pydantic import BaseModel
 from typing import List, Dict
 import json
-from hashlib import sha256
+import sys
+import time
+import uuid
 import yaml
-from octoai.types import Image
 st.set_page_config(layout="wide")
 
 BASE_PATH = Path(__file__).parent
+
+# Make the shared helpers in the repo root importable
+sys.path.insert(0, str(BASE_PATH.parent))
+from imagen.client import ImageClient
+from imagen.constants import CHECKPOINTS, SAMPLERS
+from imagen.history import reproducible
+from imagen.images import prepare_image
+from imagen.jobs import COMPLETED
+from imagen.scheduler import FairScheduler, QuotaExceeded
+from imagen.sweep import expand, label, parse_values, run_sweep
+from imagen.validation import ValidationError, Validator, nearest_resolution
+
 ENV_PATH = BASE_PATH / "local_conf.yaml"
-CONF = yaml.safe_load(ENV_PATH.open())
 
-IMAGES_PATH = BASE_PATH / "generated_images"
+@st.cache_data
+def load_conf(mtime):
+    # Only re-read the yaml file when it changes on disk
+    return yaml.safe_load(ENV_PATH.open())
 
-# Create a directory to store the images
-IMAGES_PATH.mkdir(parents=True, exist_ok=True)
+CONF = load_conf(ENV_PATH.stat().st_mtime)
+
+IMAGES_PATH = BASE_PATH / "generated_images"
 
 # Load token from yaml file
 OCTOAI_TOKEN = CONF["token"]
 OCTOAI_ENDPOINT = CONF["endpoint"]
-client = Client(token=OCTOAI_TOKEN)
 endpoint = OCTOAI_ENDPOINT + "/predict"
 healthcheck = OCTOAI_ENDPOINT + "/healthcheck"
 
+# Other deployments of the same model to balance over, as URLs or {url, weight}
+ENDPOINTS = [(OCTOAI_ENDPOINT, 1.0)] + [
+    (e["url"], e.get("weight", 1.0)) if isinstance(e, dict) else (e, 1.0) for e in CONF.get("extra_endpoints", [])
+]
+
+@st.cache_resource
+def get_image_client(endpoints, token):
+    # Connection pools, caches, history and background workers shared by every session and rerun.
+    # Keyed by token too, so a token set in the sidebar takes effect on the next rerun
+    return ImageClient(
+        endpoints,
+        token,
+        IMAGES_PATH,
+        pool_size=CONF.get("pool_size", 10),
+        max_concurrency=CONF.get("max_concurrency"),
+        http2=CONF.get("http2", False),
+        # Max disk space used by cached results before the oldest are evicted
+        cache_max_bytes=CONF.get("cache_max_bytes", 2 * 1024**3),
+        # Seconds between background health probes, and how long a healthy status is trusted
+        health_interval=CONF.get("health_interval", 30),
+        health_ttl=CONF.get("health_ttl", 60),
+        # Seconds sweep variants wait for others to share a multi-image request
+        batch_window=CONF.get("batch_window", 0.05),
+        # Generations in flight across all users, shared fairly by weight and rate limited per user
+        scheduler=FairScheduler(
+            max_in_flight=CONF.get("max_in_flight", 8),
+            interactive_slots=CONF.get("interactive_slots", 1),
+            weights=CONF.get("user_weights"),
+            images_per_minute=CONF.get("user_images_per_minute"),
+            burst=CONF.get("user_burst"),
+            max_waiting=CONF.get("user_max_waiting", 64),
+        ),
+    )
+
+image_client = get_image_client(tuple(ENDPOINTS), OCTOAI_TOKEN)
+router = image_client.router
+thumbnails = image_client.thumbnails
+result_cache = image_client.cache
+history = image_client.history
+tracer = image_client.tracer
+coalescer = image_client.coalescer
+scheduler = image_client.scheduler
+
 class Config(BaseModel):
     prompt: str
     prompt_2: str
@@ -67,6 +124,39 @@ config = Config(
 
 # Generic helper funcs
 
+# Checks requests against the documented API schema before they are sent
+validator = Validator()
+
+def prepare_payload(payload):
+    # Drop the 'default' checkpoint placeholder and snap to a valid request
+    if payload.get("model") == "default":
+        payload = {k: v for k, v in payload.items() if k != "model"}
+    # Strength only applies to img2img requests
+    init_image = st.session_state.get("init_image")
+    if init_image:
+        payload = {**payload, "init_image": init_image}
+    else:
+        payload = {k: v for k, v in payload.items() if k != "strength"}
+    return validator.snap(payload)
+
+@st.cache_data
+def prepare_init_image(data, width, height):
+    # Resize and compress an uploaded init image once, not on every rerun
+    return prepare_image(data, resolution=nearest_resolution(width, height))
+
+def checked_payload(container, payload):
+    # Return the snapped payload, reporting changes and errors in the UI
+    try:
+        payload, changes = prepare_payload(payload)
+    except ValidationError as e:
+        container.error("Invalid request: " + "; ".join(e.problems))
+        return None
+    for change in changes:
+        container.warning(f"Adjusted request: {change}")
+    for warning in validator.warnings(payload):
+        container.warning(f"{warning.capitalize()}, not in the documented lists")
+    return payload
+
 def data_updates(data=config):
     # Update the data configuration with the latest values
     payload = data.dict()
@@ -79,38 +169,79 @@ def data_updates(data=config):
         
     
 
-# Run inference with the OctoAI SDK
-def eg_octo_inference(input_payload, endpoint=endpoint, healthcheck=healthcheck):
-    if client.health_check(healthcheck) == 200:
-        
-        # Run inference
-        outputs = client.infer(endpoint_url=endpoint, inputs=input_payload)
-        
-        # Check if 'num_images' is specified in the input_payload
-        num_images = input_payload.get("num_images", 1)
-        
-        # Initialize a list to store the output file names
-        output_file_names = []
-        
-        # Loop through each image variant
-        for i in range(num_images):
-            # Get the image data for the current variant
-            image_data = outputs["completion"]["image_" + str(i)]
-            
-            # Calculate payload_id with a numerical identifier
-            payload_id = sha256(f"{input_payload}_{i}".encode()).hexdigest()
-            
-            # Generate the output file name with the numerical identifier
-            output_file_name = str(IMAGES_PATH / f"{payload_id}_octo_{i}.png")
-            #st.write("Saving image to", output_file_name)
-            
-            # Convert and save the base64 image with PIL
-            Image.from_base64(image_data).to_file(output_file_name)
-            
-            # Append the output file name to the list
-            output_file_names.append(output_file_name)
-        
-        return output_file_names
+# Run inference, reusing cached and in-flight identical generations
+def eg_octo_inference(input_payload, healthcheck=healthcheck, user="", interactive=True, on_wait=None):
+    return image_client.generate(input_payload, healthcheck, user=user, interactive=interactive, on_wait=on_wait)
+
+def current_user():
+    # Fair shares and quotas are per name, or per browser session until a name is set
+    return st.session_state.get("user") or st.session_state.setdefault("session_id", uuid.uuid4().hex[:8])
+
+def run_interactive(container, payload):
+    # Generate for the current user, showing their place in the queue while they wait
+    status = container.empty()
+    on_wait = lambda position: status.info(f"Waiting for a free slot, {position - 1} request(s) ahead of yours")
+    try:
+        return eg_octo_inference(payload, user=current_user(), on_wait=on_wait)
+    except QuotaExceeded as e:
+        container.error(f"Too many requests waiting: {e}")
+    finally:
+        status.empty()
+
+# Queue inference and return a job handle without waiting for the result
+def eg_octo_submit(input_payload, endpoint=endpoint):
+    return image_client.submit(input_payload, endpoint)
+
+# How long rendering waits for a thumbnail before falling back to the original
+THUMBNAIL_WAIT = 0.5
+
+def _select_full_res(path):
+    st.session_state["full_res"] = path
+
+def show_image(container, path, caption, key, size=300):
+    # Show a thumbnail, the full resolution image is only sent when asked for
+    container.image(thumbnails.get(path, size, wait=THUMBNAIL_WAIT), caption=caption)
+    container.button("Full size", key=key, on_click=_select_full_res, args=(path,))
+
+def show_image_grid(container, items, key, size=150, n_columns=4):
+    # Lay out (caption, files) pairs as a grid of thumbnails
+    columns = container.columns(n_columns)
+    i = 0
+    for caption, files in items:
+        for path in files:
+            show_image(columns[i % n_columns], path, caption, key=f"{key}_{i}", size=size)
+            i += 1
+
+def render_full_res(container):
+    # Full resolution view of the image picked from a grid
+    path = st.session_state.get("full_res")
+    if path:
+        container.image(path, use_column_width=True)
+        # The generation it came from, when it is in the history
+        generation = history.by_output(path)
+        if generation is not None:
+            container.caption(f"{generation['prompt']} | seed {generation['seed']} | {generation['model'] or 'default'}")
+            reproduce_button(container, generation, "full_res")
+        container.button("Close", key="close_full_res", on_click=_select_full_res, args=(None,))
+
+def render_jobs(container):
+    # Show queued jobs, rendering images as they finish
+    jobs = st.session_state.get("jobs", [])
+    if not jobs:
+        return
+    container.subheader("Queued jobs")
+    for job in reversed(jobs):
+        prompt = job.payload.get("prompt", "")
+        if not job.done:
+            container.info(f"Job {job.id} pending for {job.elapsed:.0f}s: {prompt}")
+        elif job.status == COMPLETED:
+            show_image_grid(container, [(f"Job {job.id}: {prompt}", job.files)], key=f"job{job.id}")
+        else:
+            container.error(f"Job {job.id} failed: {job.error}")
+    if any(not job.done for job in jobs):
+        # Poll the session's jobs again shortly
+        time.sleep(1)
+        st.experimental_rerun()
 
 st.markdown("""
 <style>
@@ -151,7 +282,7 @@ def sd_inputs():
         config.prompt = st.text_input("Prompt", config.prompt)
         config.prompt_2 = st.text_input("Prompt 2", config.prompt_2)
         config.negative_prompt = st.text_input("Negative Prompt", config.negative_prompt)
-        config.sampler = st.selectbox("Sampler",["DPM++2MKarras", "KLMS", "DDIM", "DDPM", "K_EULER", "K_EULER_ANCESTRAL", "DPMSolverMultistep", "PNDM", "DPMSingle", "HEUN", "DPM_2", "DPM2_ANCESTRAL"])
+        config.sampler = st.selectbox("Sampler", SAMPLERS)
         config.cfg_scale = st.slider("CFG Scale",step=0.5,value=config.cfg_scale,max_value=30.0)
         config.height = st.number_input("Height", value=config.height)
         config.width = st.number_input("Width", value=config.width)
@@ -162,10 +293,14 @@ def sd_inputs():
         config.num_images = st.number_input("Number of Images", config.num_images)
         config.high_noise_frac = st.slider("High Noise Fraction", value=config.high_noise_frac,step=0.1,max_value=1.0)
         config.strength = st.number_input("Strength", config.strength)
+        init_file = st.file_uploader("Init Image (img2img)", type=["png", "jpg", "jpeg", "webp"])
+        st.session_state["init_image"] = (
+            prepare_init_image(init_file.getvalue(), config.width, config.height) if init_file else None
+        )
         config.use_refiner = st.checkbox("Use Refiner", config.use_refiner)
         # Make model config dynamic
         # remove model key if equal 'default'
-        checkpoint_selection = st.selectbox("Custom Checkpoints", ["default","copax-timeless", "crystal-clear", "duchaiten-aiart", "realcartoon", "samaritan"])
+        checkpoint_selection = st.selectbox("Custom Checkpoints", CHECKPOINTS)
         config.model = checkpoint_selection
         if checkpoint_selection == "default":
             del config.model
@@ -183,6 +318,131 @@ def sd_inputs_loras():
         del config.loras["paint-splash"]
 
 
+# Largest grid a single sweep may expand to
+MAX_SWEEP_SIZE = CONF.get("max_sweep_size", 64)
+
+def sweep_values(label, cast, errors):
+    # Parse one sweep field, reporting bad input under it instead of failing the page
+    try:
+        return parse_values(st.text_input(label, ""), cast, limit=MAX_SWEEP_SIZE)
+    except ValueError as e:
+        st.error(f"{label}: {e}")
+        errors.append(label)
+        return []
+
+def sd_inputs_sweep():
+    # Each field takes a comma separated list or an inclusive start:stop:step range
+    st.write("Give any field several values to sweep over, e.g. `7, 9, 11` or `10:30:5`. Empty fields keep the Text2Image value.")
+    errors = []
+    col1, col2 = st.columns(2)
+    with col1:
+        axes = {
+            "cfg_scale": sweep_values("CFG Scale values", float, errors),
+            "steps": sweep_values("Steps values", int, errors),
+            "seed": sweep_values("Seed values", int, errors),
+            "sampler": st.multiselect("Samplers", SAMPLERS),
+        }
+    with col2:
+        axes["high_noise_frac"] = sweep_values("High Noise Fraction values", float, errors)
+        axes["model"] = [m for m in st.multiselect("Checkpoints", CHECKPOINTS) if m != "default"]
+        axes["loras.crayon-style"] = sweep_values("Crayon Style weights", float, errors)
+        axes["loras.paint-splash"] = sweep_values("Paint Splash weights", float, errors)
+        concurrency = st.slider("Concurrent requests", min_value=1, max_value=16, value=4)
+        merge_seeds = st.checkbox(
+            "Batch seeds into multi-image requests",
+            help="Up to 4 seeds share one request. Faster, but each image is a variant that can't be reproduced from its seed.",
+        )
+    # No sweep runs until every field parses
+    return (None if errors else axes), concurrency, merge_seeds
+
+
+def render_sweep(container, axes, concurrency, merge_seeds=False):
+    # Expand the grid, skip cached combinations and fill in images as they finish
+    if axes is None:
+        container.error("Fix the invalid sweep values first")
+        return
+    try:
+        # Checks the size before building the grid
+        grid = expand(config.dict(), axes, limit=MAX_SWEEP_SIZE)
+    except ValueError as e:
+        container.error(str(e))
+        return
+    # Validate the whole grid before sending anything
+    problems = []
+    for i, (labels, payload) in enumerate(grid):
+        try:
+            grid[i] = (labels, prepare_payload(payload)[0])
+        except ValidationError as e:
+            problems.append(f"{label(labels)}: {'; '.join(e.problems)}")
+    if problems:
+        container.error("Invalid sweep combinations:\n\n" + "\n\n".join(problems))
+        return
+    container.subheader(f"Sweep: {len(grid)} combinations")
+    columns = container.columns(4)
+    placeholders = [columns[i % 4].empty() for i in range(len(grid))]
+    for i, (labels, _) in enumerate(grid):
+        placeholders[i].info(f"Pending: {label(labels)}")
+    lookup = lambda payload: image_client.cached(payload, count_miss=False)
+    results = []
+    # Worker threads can't read the session state, so look the user up here
+    user = current_user()
+    if merge_seeds:
+        # Merged images don't belong to their payload's seed, so they are neither looked up nor cached under it
+        run, lookup = lambda payload: image_client.generate_variant(payload, user=user), None
+    else:
+        # Sweeps leave the interactive slots to single generations
+        run = lambda payload: eg_octo_inference(payload, user=user, interactive=False)
+    for index, files, error in run_sweep(grid, run, concurrency, lookup=lookup):
+        caption = label(grid[index][0])
+        if files:
+            cell = placeholders[index].container()
+            for n, path in enumerate(files):
+                show_image(cell, path, caption, key=f"sweep_{index}_{n}", size=150)
+            results.append((index, caption, files))
+        else:
+            placeholders[index].error(f"{caption}: {error or 'endpoint unhealthy'}")
+    # Keep the grid, in sweep order, so it survives reruns
+    st.session_state["sweep"] = [(caption, files) for _, caption, files in sorted(results)]
+
+
+def _reproduce(payload):
+    st.session_state["reproduce"] = payload
+
+def reproduce_button(container, generation, key):
+    # The history doesn't keep input images, so img2img and ControlNet runs can't be resent
+    if reproducible(generation["payload"]):
+        container.button("Reproduce", key=f"reproduce_{key}{generation['id']}", on_click=_reproduce, args=(generation["payload"],))
+    else:
+        container.button("Reproduce", key=f"reproduce_{key}{generation['id']}", disabled=True,
+                         help="Made from an input image, which the history doesn't keep")
+
+def render_history():
+    # Search past generations by prompt text, checkpoint, LoRA and seed
+    col1, col2 = st.columns(2)
+    with col1:
+        text = st.text_input("Prompt search", "", help="Full text query, e.g. `cat AND fishbowl`")
+        seed = st.text_input("Seed", "")
+    with col2:
+        model = st.selectbox("Checkpoint", ["any"] + CHECKPOINTS[1:])
+        lora = st.selectbox("LoRA", ["any", "crayon-style", "paint-splash"])
+    try:
+        results = history.search(
+            text=text or None,
+            model=None if model == "any" else model,
+            lora=None if lora == "any" else lora,
+            seed=int(seed) if seed.strip() else None,
+            limit=20,
+        )
+    except Exception as e:
+        st.error(f"Invalid search: {e}")
+        return
+    st.caption(f"{len(results)} most recent of {history.count()} generations")
+    for result in results:
+        caption = f"{result['prompt']} | seed {result['seed']} | {result['model'] or 'default'} | {result['latency'] or 0:.1f}s"
+        show_image_grid(st, [(caption, result["files"])], key=f"history{result['id']}")
+        reproduce_button(st, result, "history")
+
+
 def main():
 
     st.title('OctoAI Imagen & SDXL Evaluation | Typeface')
@@ -191,6 +451,7 @@ def main():
     st.sidebar.title("Quickstart")
     your_token=st.sidebar.text_input("Enter your OctoML SDXL token", value="your-token")
     endpoint_url=st.sidebar.text_input("Enter your OctoML SDXL endpoint", value="https://image.octoai.run")
+    st.sidebar.text_input("Your name", key="user", help="The endpoint is shared fairly between names, every session of a name shares its quota")
     
     # If the user has entered a token and endpoint
     # Update token yaml configuration file
@@ -205,6 +466,59 @@ def main():
             yaml.dump(CONF, f)
     
     inference_button = st.sidebar.button("Run Inference")
+    queue_button = st.sidebar.button("Queue Inference")
+    sweep_button = st.sidebar.button("Run Sweep")
+    
+    # Endpoint health from the background monitor, never blocks the render
+    health = image_client.health_monitor(healthcheck).status()
+    if health["healthy"]:
+        st.sidebar.success(f"Endpoint healthy ({health['latency'] * 1000:.0f} ms)")
+    elif health["healthy"] is None:
+        st.sidebar.info("Checking endpoint health...")
+    else:
+        st.sidebar.error(f"Endpoint unhealthy {health['error'] or ''}")
+    
+    # Cache statistics
+    cache_stats = result_cache.stats()
+    st.sidebar.caption(f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+    coalescer_stats = coalescer.stats()
+    st.sidebar.caption(
+        f"Deduplication: {coalescer_stats['generated']} generated, {coalescer_stats['joined']} joined in flight, "
+        f"{coalescer_stats['reused']} reused"
+    )
+    for endpoint_stats in router.stats():
+        st.sidebar.caption(
+            f"{endpoint_stats['url']}: concurrency limit {endpoint_stats['limit']}, "
+            f"{endpoint_stats['outstanding']} in flight, {endpoint_stats['errors']} errors, circuit {endpoint_stats['state']}"
+        )
+    st.sidebar.caption(f"{router.waiting} requests queued")
+    scheduler_stats = scheduler.stats()
+    own_stats = scheduler_stats["users"].get(current_user(), {})
+    st.sidebar.caption(
+        f"Scheduler: {scheduler_stats['in_flight']} generating, {scheduler_stats['waiting']} waiting across "
+        f"{len(scheduler_stats['users'])} users; you: {own_stats.get('in_flight', 0)} generating, "
+        f"{own_stats.get('waiting', 0)} waiting, {own_stats.get('images', 0)} images"
+    )
+    
+    # Where request time goes, per phase
+    timings = tracer.summary()
+    if timings:
+        with st.sidebar.expander("Request timings"):
+            st.dataframe(
+                [
+                    {
+                        "client": row["client"],
+                        "phase": row["phase"],
+                        "n": row["count"],
+                        "mean ms": round(row["mean"] * 1000, 1),
+                        "p50 ms": round(row["p50"] * 1000, 1),
+                        "p95 ms": round(row["p95"] * 1000, 1),
+                    }
+                    for row in timings
+                ],
+                hide_index=True,
+            )
+            st.download_button("Prometheus metrics", tracer.prometheus(), file_name="octoai_metrics.prom")
     
     # Layout
     
@@ -213,7 +527,7 @@ def main():
     with col2:
         container1 = st.container()
 
-        tab1,tab2 = container1.tabs(["Text2Image","Lora Configs"])
+        tab1,tab2,tab3,tab4 = container1.tabs(["Text2Image","Lora Configs","Sweep","History"])
         with tab1:
             # Display config params
             sd_inputs()
@@ -222,18 +536,53 @@ def main():
             # Display config params
             sd_inputs_loras()
             
+        with tab3:
+            # Display sweep params
+            sweep_axes, sweep_concurrency, sweep_merge_seeds = sd_inputs_sweep()
+            
+        with tab4:
+            # Browse past generations
+            render_history()
+            
+    render_full_res(container1)
     img_placeholder = container1.empty()
         
     if inference_button:
 
         # Run inference
         # Drop model key if equal 'default'
-        img_res = eg_octo_inference(config.dict())
-        
-        # Update placeholder with image
-        img_placeholder.image(img_res, width=300)
+        payload = checked_payload(container1, config.dict())
+        if payload is not None:
+            img_res = run_interactive(container1, payload)
+            
+            # Remember the result so it stays on screen across reruns
+            st.session_state["last_result"] = img_res or []
+    
+    if st.session_state.get("reproduce"):
+        # Re-run a payload picked from the history, checked against today's schema and names
+        payload = checked_payload(container1, st.session_state.pop("reproduce"))
+        if payload is not None:
+            st.session_state["last_result"] = run_interactive(container1, payload) or []
+    
+    # Update placeholder with thumbnails of the last result
+    if st.session_state.get("last_result"):
+        show_image_grid(img_placeholder.container(), [("", st.session_state["last_result"])], key="last", size=300, n_columns=2)
+    
+    if queue_button:
+        # Queue the current config and keep going without waiting on it
+        payload = checked_payload(container1, config.dict())
+        if payload is not None:
+            st.session_state.setdefault("jobs", []).append(eg_octo_submit(payload))
+    
+    if sweep_button:
+        # Run every combination of the sweep values in parallel
+        render_sweep(container1, sweep_axes, sweep_concurrency, sweep_merge_seeds)
+    elif st.session_state.get("sweep"):
+        container1.subheader("Last sweep")
+        show_image_grid(container1, st.session_state["sweep"], key="sweep")
                 
     container1.write(config.dict())
+    jobs_container = container1.container()
             
     # Sections
     # Section 1
@@ -270,6 +619,21 @@ def main():
                 You can also generate multiple images at once. Try changing the number of images to `3`.
                 """)
         
+        # Section 3b - Queued jobs
+        st.subheader("Queue several configurations")
+        st.write(""" 
+                Press _Queue Inference_ instead to submit the current configuration as a background job. You can keep
+                changing parameters and queueing more jobs, and each result appears below the payload as it finishes.
+                """)
+        
+        # Section 3c - Sweeps
+        st.subheader("Parameter sweeps")
+        st.write(""" 
+                To compare settings side by side, give several values to any field in the `Sweep` tab, for example CFG scale
+                `5, 7.5, 11` and steps `20:40:10`, then press _Run Sweep_. Every combination runs in parallel and the grid fills in
+                as images finish. Combinations generated before come straight from the result cache.
+                """)
+        
         # Seection 4 - Custom checkpoints
         st.subheader("Custom checkpoints")
         st.write(""" 
@@ -287,6 +651,9 @@ def main():
         st.write(""" 
                 Navigate to the full SDXL Image Gen API refernece from the sidebar.
                 """)
+    
+    # Render queued jobs last, this reruns the script while any are pending
+    render_jobs(jobs_container)
 
     
             
@@ -1,28 +1,37 @@
 """Query ControlNet SDXL."""
 
-import base64
-import io
 import os
+import sys
 import time
 
-import PIL.Image
-import requests
 from pathlib import Path
 BASE_PATH = Path(__file__).parent.resolve()
 
+# Make the shared helpers in the repo root importable
+sys.path.insert(0, str(BASE_PATH.parent))
+from imagen.constants import CANNY_A10_URL, CANNY_A100_URL
+from imagen.history import History
+from imagen.images import prepare_image
+from imagen.jobs import JobClient
+from imagen.router import Router
+from imagen.session import get_session
+from imagen.stream import image_files, stream_to_files
+from imagen.tracing import Trace, Tracer
+
 prod_token = os.environ.get("OCTOAI_TOKEN")  # noqa
 assert prod_token is not None, "OCTOAI_TOKEN environment variable not set"
 
+# Record every generation so results can be searched and reproduced later
+HISTORY_PATH = "octoai_history.sqlite"
+
 
-def _process_test(endpoint_url):
+def _process_test(router, local_canny=False, tracer=None):
     image_path = BASE_PATH / "logo.png"
-    image = PIL.Image.open(image_path)
+    trace = Trace(tracer, "canny")
 		
-		# Create a BytesIO buffer to hold the image data
-    image_buffer = io.BytesIO()
-    image.save(image_buffer, format='PNG')
-    image_bytes = image_buffer.getvalue()
-    encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+		# Resize and compress the control image before upload
+    with trace.phase("prepare"):
+        encoded_image = prepare_image(image_path, canny=local_canny)
 
 
     model_request = {
@@ -39,31 +48,79 @@ def _process_test(endpoint_url):
 
     prod_token = os.environ.get("OCTOAI_TOKEN")  # noqa
     start = time.time()
-    reply = requests.post(
-        f"{endpoint_url}",
+    # Send to the best deployment, failing over to the others on errors and 429s
+    reply = router.send(
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {prod_token}",
 						'X-OctoAI-Queue-Dispatch': 'true'
         },
         json=model_request,
+        stream=True,
+        trace=trace,
     )
-    print(f"Generation took {time.time()-start} seconds")
-
     assert reply.status_code == 200
 
-    img_list = reply.json()["images"]
+    # The server already sends PNGs, decode them straight into their files without re-encoding
+    files = image_files(stream_to_files(reply, lambda i: f"result_image{i}.png", trace=trace))
+    latency = time.time() - start
+    print(f"Generation on {reply.url} took {latency} seconds")
+
+    with trace.phase("record"):
+        History(HISTORY_PATH).record(
+            model_request,
+            files,
+            endpoint=reply.url,
+            latency=latency,
+            source="canny",
+        )
+    trace.finish()
 
-    for i, ibytes in enumerate(img_list):
-        img_bytes = base64.b64decode(ibytes)
-        img = PIL.Image.open(io.BytesIO(img_bytes))
-        img.load()
-        img.save(f"result_image{i}.png")
+
+def _process_test_async(endpoint_url, prompts, local_canny=False):
+    # Submit every prompt up front, then save results as each job finishes
+    encoded_image = prepare_image(BASE_PATH / "logo.png", canny=local_canny)
+    client = JobClient(prod_token, session=get_session(prod_token, endpoint_url))
+
+    jobs = []
+    for p, prompt in enumerate(prompts):
+        model_request = {
+            "image": encoded_image,
+            "prompt": prompt,
+            "negative_prompt": "low quality, bad quality, sketches",
+            "num_inference_steps": 50,
+            "controlnet_conditioning_scale": 0.5,
+            "num_images_per_prompt": 1
+        }
+        jobs.append(client.submit(endpoint_url, model_request, lambda i, p=p: f"result_image{p}_{i}.png"))
+    print(f"Submitted {len(jobs)} jobs")
+
+    history = History(HISTORY_PATH)
+    for job in client.as_completed(jobs):
+        if job.error:
+            print(f"Job {job.id} failed after {job.elapsed:.1f} seconds: {job.error}")
+        else:
+            print(f"Job {job.id} took {job.elapsed:.1f} seconds: {job.files}")
+            history.record(job.payload, job.files, endpoint=endpoint_url, latency=job.elapsed, source="canny")
 
 
 if __name__ == "__main__":
-    a10 = "https://control-sdxl2-vvwbynjr46vc.octoai.run/canny"
-    a100 = "https://controlnet-sdxl-a100-vvwbynjr46vc.octoai.run/canny"
+    a10 = CANNY_A10_URL
+    a100 = CANNY_A100_URL
+
+    # Pass --local-canny to send a precomputed edge map instead of the image
+    local_canny = "--local-canny" in sys.argv
 
-    # Change this line to call either a10 or a100
-    _process_test(a100)
\ No newline at end of file
+    # Pass --async to queue several prompts instead of blocking on one
+    if "--async" in sys.argv:
+        _process_test_async(a100, [
+            "aerial view, a futuristic research complex in a bright foggy jungle, hard lighting",
+            "aerial view, a medieval castle on a misty mountain, golden hour",
+            "aerial view, a neon city at night in the rain, cinematic lighting",
+        ], local_canny=local_canny)
+    else:
+        # Balance over both deployments, list more (optionally with weights) to add them
+        router = Router([a10, a100], prod_token)
+        tracer = Tracer()
+        _process_test(router, local_canny=local_canny, tracer=tracer)
+        tracer.print_summary()
\ No newline at end of file
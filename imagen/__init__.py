@@ -0,0 +1 @@
+"""Shared helpers for the OctoAI image generation examples."""
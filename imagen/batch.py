@@ -0,0 +1,268 @@
+"""Concurrent batch generation against an OctoAI image endpoint."""
+
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+from imagen.limiter import AdaptiveLimiter, send
+from imagen.manifest import DONE, FAILED
+from imagen.microbatch import MicroBatcher
+from imagen.session import get_session
+from imagen.singleflight import Coalescer
+from imagen.stream import image_files, stream_to_files
+from imagen.tracing import Trace
+
+
+def load_jobs(path, base_payload: Dict) -> Iterator[Tuple[str, Dict]]:
+    """Yield ``(job_id, payload)`` pairs from a JSONL file of overrides.
+
+    Each line is either a JSON object merged over ``base_payload`` or a bare
+    JSON string used as the prompt. An ``id`` field names the job, otherwise
+    the line number is used.
+    """
+    with open(path) as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            overrides = json.loads(line)
+            if isinstance(overrides, str):
+                overrides = {"prompt": overrides}
+            job_id = str(overrides.pop("id", line_no))
+            yield job_id, {**base_payload, **overrides}
+
+
+class BatchEngine:
+    """Dispatch many generation requests through a bounded thread pool.
+
+    ``concurrency`` is the most requests ever in flight. Within it an
+    ``AdaptiveLimiter`` finds how many the endpoint serves without queueing
+    or throttling; pass ``adaptive=False`` to always use all of them. Pass a
+    ``Router`` to spread the requests over several endpoints instead of
+    ``url``, and a ``Manifest`` to record each job so an interrupted run
+    can resume. With a ``batch_window`` jobs that differ only in image count
+    (and seed, with ``merge_seeds``) are sent together as multi-image
+    requests, see ``imagen.microbatch``. Pass an ``OutputStage`` to convert
+    each job's images once it finishes; images are otherwise kept exactly as
+    the server sent them.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: Optional[str],
+        out_dir="octoai_batch",
+        concurrency: int = 8,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 300.0,
+        http2: bool = False,
+        history=None,
+        adaptive: bool = True,
+        tracer=None,
+        router=None,
+        manifest=None,
+        batch_window: float = 0.0,
+        merge_seeds: bool = False,
+        output=None,
+    ):
+        self.url = url
+        self.history = history
+        self.tracer = tracer
+        self.router = router
+        self.manifest = manifest
+        self.output = output
+        self.coalescer = Coalescer()
+        self.batcher = MicroBatcher(self.generate_batch, window=batch_window, merge_seeds=merge_seeds) if batch_window > 0 else None
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = get_session(token, url, pool_size=concurrency, http2=http2)
+        # A router limits each of its endpoints itself
+        self.limiter = AdaptiveLimiter(initial=min(4, concurrency), max_limit=concurrency) if adaptive and router is None else None
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.images = 0
+
+    def post(self, payload: Dict, trace: Optional[Trace] = None) -> requests.Response:
+        """POST ``payload``, retrying on 429/5xx and connection errors."""
+        if self.router is not None:
+            return self.router.send(
+                max_retries=self.max_retries,
+                backoff=self.backoff,
+                trace=trace,
+                json=payload,
+                timeout=self.timeout,
+                stream=True,
+            )
+        return send(
+            self.session,
+            self.url,
+            limiter=self.limiter,
+            max_retries=self.max_retries,
+            backoff=self.backoff,
+            trace=trace,
+            json=payload,
+            timeout=self.timeout,
+            stream=True,
+        )
+
+    def save(
+        self,
+        job_id: str,
+        response: requests.Response,
+        trace: Optional[Trace] = None,
+        names: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Stream the images in ``response`` to the output directory.
+
+        Image ``i`` is saved as ``<names[i]>.png``, by default ``<job_id>_<i>.png``.
+        """
+
+        def image_path(i):
+            name = names[i] if names is not None and i < len(names) else f"{job_id}_{i}"
+            return str(self.out_dir / f"{name}.png")
+
+        metadata = stream_to_files(response, image_path, trace=trace)
+        return image_files(metadata)
+
+    def generate(self, job_id: str, payload: Dict, trace: Trace, names: Optional[List[str]] = None) -> List[str]:
+        """Send ``payload`` and save its images under ``job_id``."""
+        start = time.time()
+        response = self.post(payload, trace)
+        if response.status_code != 200:
+            raise RuntimeError(f"Request failed with status code {response.status_code}: {response.text[:200]}")
+        files = self.save(job_id, response, trace, names)
+        if self.history is not None:
+            # Record the files the output stage will leave behind, run() points
+            # the record back at the PNG if a conversion fails
+            recorded = self.output.targets(files) if self.output is not None else files
+            with trace.phase("record"):
+                self.history.record(payload, recorded, endpoint=response.url, latency=time.time() - start, source="batch")
+        return files
+
+    def generate_batch(self, payload: Dict, tags: List[Tuple[str, Trace, int]]) -> List[str]:
+        """Send a micro-batched request, naming each image after the job it goes back to."""
+        names = [f"{job_id}_{i}" for job_id, _, num_images in tags for i in range(num_images)]
+        job_id, trace, _ = tags[0]
+        return self.generate(job_id, payload, trace, names)
+
+    def link(self, job_id: str, files: List[str]) -> List[str]:
+        """Give ``job_id`` its own names for images generated by another job."""
+        linked = []
+        for i, source in enumerate(files):
+            target = self.out_dir / f"{job_id}_{i}.png"
+            tmp_path = target.with_name(target.name + ".tmp")
+            if tmp_path.exists():
+                tmp_path.unlink()
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, target)
+            linked.append(str(target))
+        return linked
+
+    def run_one(self, job_id: str, payload: Dict) -> Dict:
+        with Trace(self.tracer, "batch", job=job_id) as trace:
+            start = time.time()
+            if self.batcher is not None:
+                generate = lambda p: self.batcher.run(p, (job_id, trace, int(p.get("num_images", 1))))
+            else:
+                generate = lambda p: self.generate(job_id, p, trace)
+            # Repeated rows share one request
+            files, shared = self.coalescer.run(payload, self.url, generate)
+            if shared:
+                with trace.phase("write"):
+                    files = self.link(job_id, files)
+        return {"id": job_id, "files": files, "latency": time.time() - start, "shared": shared}
+
+    def _finish(self, job_id: str, payload: Dict, result: Dict, on_result: Optional[Callable[[Dict], None]]):
+        if self.manifest is not None:
+            if "error" in result:
+                self.manifest.record(job_id, payload, FAILED, error=result["error"])
+            else:
+                self.manifest.record(job_id, payload, DONE, result["files"], result["latency"])
+        if on_result is not None:
+            on_result(result)
+
+    def run(
+        self,
+        jobs: Iterable[Tuple[str, Dict]],
+        on_result: Optional[Callable[[Dict], None]] = None,
+    ) -> Dict:
+        """Run all ``jobs``, keeping at most ``concurrency`` requests in flight.
+
+        Results are saved and passed to ``on_result`` as soon as each request
+        completes, or with an output stage once its images are converted.
+        Returns throughput statistics for the whole run.
+        """
+        jobs = iter(jobs)
+        start = time.time()
+        pending = {}
+        # Conversion future -> finished job waiting for its final file names
+        converting = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            def submit_next():
+                for job_id, payload in jobs:
+                    pending[executor.submit(self.run_one, job_id, payload)] = job_id, payload
+                    return True
+                return False
+
+            # Keep the pool saturated without materializing the whole job list
+            while len(pending) < self.concurrency and submit_next():
+                pass
+            while pending or converting:
+                done, _ = wait([*pending, *converting], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in converting:
+                        job_id, payload, result = converting.pop(future)
+                        files = future.result()
+                        if self.history is not None:
+                            # A failed conversion leaves the PNG, not the file recorded for it
+                            for target, path in zip(self.output.targets(result["files"]), files):
+                                if target != path:
+                                    self.history.replace_path(target, path)
+                        self._finish(job_id, payload, {**result, "files": files}, on_result)
+                        continue
+                    job_id, payload = pending.pop(future)
+                    try:
+                        result = future.result()
+                        with self._lock:
+                            self.completed += 1
+                            self.images += len(result["files"])
+                    except Exception as e:
+                        result = {"id": job_id, "error": str(e)}
+                        with self._lock:
+                            self.failed += 1
+                    if self.output is not None and "error" not in result:
+                        # Convert in the background, the job is reported once its files are final
+                        converting[self.output.submit(result["files"], payload)] = job_id, payload, result
+                    else:
+                        self._finish(job_id, payload, result, on_result)
+                    submit_next()
+        elapsed = time.time() - start
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "images": self.images,
+            "seconds": elapsed,
+            "images_per_minute": self.images / elapsed * 60 if elapsed else 0.0,
+            "coalesced": self.coalescer.joined + self.coalescer.reused,
+            **({"microbatch": self.batcher.stats()} if self.batcher is not None else {}),
+            **({"output": self.output.stats()} if self.output is not None else {}),
+            **({"limiter": self.limiter.stats()} if self.limiter is not None else {}),
+            **({"endpoints": self.router.stats()} if self.router is not None else {}),
+        }
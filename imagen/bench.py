@@ -0,0 +1,187 @@
+"""Latency benchmark over endpoints, samplers, steps and resolutions.
+
+Run with ``python -m imagen.bench``. Each cell of the matrix gets ``--warmup``
+untimed requests followed by ``--repeat`` timed ones, and the results are
+reported as p50/p90/p99 latency and images/sec::
+
+    python -m imagen.bench --endpoint https://image.octoai.run/predict \\
+        --samplers K_EULER DDIM --steps 20 30 --resolutions 1024x1024 --out bench.csv
+
+Pass ``--mock`` to run the same matrix against a local
+``imagen.mock_server`` instead, e.g. to catch client-side regressions offline.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from imagen.constants import SAMPLERS
+from imagen.tracing import percentile
+
+DEFAULT_PROMPT = "A cat in a fishbowl hyperrealism"
+
+RESULT_FIELDS = [
+    "endpoint", "sampler", "steps", "width", "height", "num_images", "requests", "errors",
+    "p50", "p90", "p99", "mean", "images_per_sec",
+]
+
+
+def is_canny(endpoint: str) -> bool:
+    return endpoint.rstrip("/").endswith("/canny")
+
+
+def build_payload(endpoint: str, sampler: str, steps: int, width: int, height: int, num_images: int, image=None) -> Dict:
+    """Build the request body for one benchmark cell on ``endpoint``."""
+    if is_canny(endpoint):
+        return {
+            "image": image,
+            "prompt": DEFAULT_PROMPT,
+            "num_inference_steps": steps,
+            "width": width,
+            "height": height,
+            "num_images_per_prompt": num_images,
+            "controlnet_conditioning_scale": 0.5,
+            "seed": 42,
+        }
+    return {
+        "prompt": DEFAULT_PROMPT,
+        "sampler": sampler,
+        "cfg_scale": 7.5,
+        "steps": steps,
+        "width": width,
+        "height": height,
+        "num_images": num_images,
+        "seed": 42,
+        "use_refiner": False,
+    }
+
+
+def matrix(endpoints, samplers, steps, resolutions, num_images):
+    """Yield every ``(endpoint, sampler, steps, width, height, num_images)`` cell."""
+    for endpoint in endpoints:
+        # ControlNet has no sampler parameter, so it only gets one sampler column
+        endpoint_samplers = ["-"] if is_canny(endpoint) else samplers
+        for sampler, step, (width, height), n in itertools.product(endpoint_samplers, steps, resolutions, num_images):
+            yield endpoint, sampler, step, width, height, n
+
+
+def run_cell(session, endpoint, payload, warmup: int, repeat: int, out_dir) -> Dict:
+    from imagen.stream import image_files, stream_to_files
+
+    latencies = []
+    errors = 0
+    images = 0
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        try:
+            response = session.post(endpoint, json=payload, stream=True)
+            if response.status_code != 200:
+                response.close()
+                raise RuntimeError(f"status {response.status_code}")
+            # Decode to disk like the real clients so client-side cost is included
+            metadata = stream_to_files(response, lambda n: os.path.join(out_dir, f"bench_{n}.png"))
+        except Exception as e:
+            if i >= warmup:
+                errors += 1
+                print(f"  request failed: {e}", file=sys.stderr)
+            continue
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            latencies.append(elapsed)
+            images += len(image_files(metadata))
+    total = sum(latencies)
+    return {
+        "requests": repeat,
+        "errors": errors,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "mean": total / len(latencies) if latencies else float("nan"),
+        "images_per_sec": images / total if total else 0.0,
+    }
+
+
+def run_benchmark(args) -> List[Dict]:
+    from imagen.images import encode_image_file
+    from imagen.session import get_session
+
+    image = encode_image_file(args.image) if any(is_canny(e) for e in args.endpoint) else None
+    resolutions = [tuple(int(v) for v in r.lower().split("x")) for r in args.resolutions]
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for endpoint, sampler, steps, width, height, n in matrix(
+            args.endpoint, args.samplers, args.steps, resolutions, args.num_images
+        ):
+            payload = build_payload(endpoint, sampler, steps, width, height, n, image=image)
+            row = {
+                "endpoint": endpoint, "sampler": sampler, "steps": steps,
+                "width": width, "height": height, "num_images": n,
+            }
+            session = get_session(args.token, endpoint, pool_size=1, http2=args.http2)
+            row.update(run_cell(session, endpoint, payload, args.warmup, args.repeat, out_dir))
+            print(
+                f"{endpoint} {sampler} steps={steps} {width}x{height} n={n}: "
+                f"p50={row['p50']:.3f}s p90={row['p90']:.3f}s p99={row['p99']:.3f}s "
+                f"{row['images_per_sec']:.2f} img/s"
+            )
+            results.append(row)
+    return results
+
+
+def write_results(results: List[Dict], path: str):
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark OctoAI image generation latency")
+    parser.add_argument("--endpoint", nargs="+", default=["https://image.octoai.run/predict"],
+                        help="Endpoint URLs; URLs ending in /canny get a ControlNet payload")
+    parser.add_argument("--samplers", nargs="+", default=["DPM++2MKarras"],
+                        help="Samplers to compare, or 'all' for every sampler in the app")
+    parser.add_argument("--steps", nargs="+", type=int, default=[20])
+    parser.add_argument("--resolutions", nargs="+", default=["1024x1024"], help="WIDTHxHEIGHT values")
+    parser.add_argument("--num-images", nargs="+", type=int, default=[1])
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed requests per cell")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed requests per cell")
+    parser.add_argument("--image", default=os.path.join(os.path.dirname(__file__), "..", "example_python", "logo.png"),
+                        help="Control image for /canny endpoints")
+    parser.add_argument("--token", default=os.environ.get("OCTOAI_TOKEN"))
+    parser.add_argument("--out", help="Write results to a .csv or .json file")
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 (requires httpx[http2])")
+    parser.add_argument("--mock", action="store_true", help="Send requests to a local mock server")
+    parser.add_argument("--mock-latency", default="fixed:0", help="Mock server latency distribution")
+    args = parser.parse_args(argv)
+    if args.samplers == ["all"]:
+        args.samplers = SAMPLERS
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mock:
+        from imagen.mock_server import MockConfig, start_in_thread
+
+        # Keep each endpoint's path so /predict and /canny are still told apart
+        server = start_in_thread(MockConfig(latency=args.mock_latency))
+        args.endpoint = [server.url + urlsplit(e).path for e in args.endpoint]
+    results = run_benchmark(args)
+    if args.out:
+        write_results(results, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Content-addressed result cache for generated images."""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Number of decimal places kept when normalizing floats in a payload
+FLOAT_PRECISION = 6
+
+
+def _normalize(value):
+    # Normalize a payload value so equivalent configs serialize identically
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, float):
+        value = round(value, FLOAT_PRECISION)
+        return int(value) if value.is_integer() else value
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def canonical_payload(payload: Dict) -> str:
+    """Serialize a payload with sorted keys and normalized floats."""
+    return json.dumps(_normalize(payload), sort_keys=True, separators=(",", ":"))
+
+
+def payload_key(payload: Dict, endpoint: str = "") -> str:
+    """Return the sha256 cache key for a payload sent to an endpoint."""
+    return sha256(f"{endpoint}|{canonical_payload(payload)}".encode()).hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of generated image files.
+
+    Entries map a payload key to the list of image files produced for it. The
+    index is kept in memory and persisted to ``index.json`` in the cache
+    directory, so lookups never list the directory. ``on_evict`` is called
+    with each file removed by eviction, e.g. to clean up derived files.
+
+    Hits and new entries only change the index in memory; it is written at
+    most every ``save_interval`` seconds and at interpreter exit, so neither
+    a lookup nor a put rewrites the whole index each time. ``flush()`` writes
+    it right away. Entries added after the last save are lost if the process
+    is killed; their files are still on disk but are no longer served.
+    """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(
+        self,
+        path,
+        max_bytes: int = 2 * 1024**3,
+        on_evict: Optional[Callable[[str], None]] = None,
+        save_interval: float = 30.0,
+    ):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / self.INDEX_NAME
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._size = 0
+        self._dirty = False
+        self._saved_at = time.time()
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        # Load the index, oldest entries first
+        if not self.index_path.exists():
+            return
+        try:
+            entries = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            return
+        for key, entry in sorted(entries.items(), key=lambda kv: kv[1]["last_used"]):
+            self._entries[key] = entry
+            self._size += entry["size"]
+
+    def _save(self):
+        # Write the index atomically so a crash never leaves it half written
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._entries))
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+        self._saved_at = time.time()
+
+    def _touch(self):
+        # Called with the lock held after an in-memory only change
+        self._dirty = True
+        if time.time() - self._saved_at >= self.save_interval:
+            self._save()
+
+    def flush(self):
+        """Write recency updates that haven't been saved yet."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def key(self, payload: Dict, endpoint: str = "") -> str:
+        return payload_key(payload, endpoint)
+
+    def get(self, key: str, count_miss: bool = True) -> Optional[List[str]]:
+        """Return the cached file names for ``key`` or None on a miss.
+
+        Pass ``count_miss=False`` for lookups that fall through to a call
+        which checks the cache again, so misses are not counted twice.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not all(os.path.exists(f) for f in entry["files"]):
+                if entry is not None:
+                    self._drop(key)
+                    self._touch()
+                if count_miss:
+                    self.misses += 1
+                return None
+            entry["last_used"] = time.time()
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._touch()
+            return list(entry["files"])
+
+    def put(self, key: str, files: List[str]):
+        """Record the files generated for ``key`` and evict old entries."""
+        with self._lock:
+            if key in self._entries:
+                self._drop(key, remove_files=False)
+            size = sum(os.path.getsize(f) for f in files)
+            self._entries[key] = {"files": list(files), "size": size, "last_used": time.time()}
+            self._size += size
+            self._evict()
+            self._touch()
+
+    def _drop(self, key: str, remove_files: bool = True):
+        entry = self._entries.pop(key)
+        self._size -= entry["size"]
+        if remove_files:
+            for f in entry["files"]:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                if self.on_evict is not None:
+                    self.on_evict(f)
+
+    def _evict(self):
+        # Evict least recently used entries until we fit, always keeping the newest
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
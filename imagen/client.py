@@ -0,0 +1,240 @@
+"""Image generation client behind the Streamlit app.
+
+``ImageClient`` ties together everything a generation goes through besides
+the UI: the result cache, coalescing of identical requests, micro-batching
+of variants, fair scheduling between users, the router over the
+deployments, health monitoring, streaming the images to disk, history,
+phase timings, thumbnails and the queued job poller. It is importable
+without Streamlit, and the modules that pull in ``requests`` are only
+imported when the client is built.
+"""
+
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from imagen.cache import ResultCache
+from imagen.history import History
+from imagen.microbatch import DEFAULT_WINDOW, MicroBatcher
+from imagen.scheduler import FairScheduler
+from imagen.singleflight import Coalescer
+from imagen.thumbs import ThumbnailPipeline
+from imagen.tracing import Tracer
+
+
+class ImageClient:
+    """Generate images on a pool of deployments, caching every result.
+
+    ``endpoints`` are ``(base_url, weight)`` pairs; requests go to
+    ``<base_url>/predict`` and health probes to ``<base_url>/healthcheck``.
+    Images, thumbnails, the cache index, history and traces all live under
+    ``images_path``. Generations wait for a slot from ``scheduler`` under the
+    name of the ``user`` asking for them.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[Tuple[str, float]],
+        token: Optional[str],
+        images_path,
+        pool_size: int = 10,
+        max_concurrency: Optional[int] = None,
+        http2: bool = False,
+        cache_max_bytes: int = 2 * 1024**3,
+        health_interval: float = 30.0,
+        health_ttl: float = 60.0,
+        batch_window: float = DEFAULT_WINDOW,
+        scheduler: Optional[FairScheduler] = None,
+        source: str = "app",
+    ):
+        from imagen.router import Router
+        from imagen.session import get_session
+
+        self.token = token
+        self.source = source
+        self.base_url = endpoints[0][0]
+        self.endpoint = self.base_url + "/predict"
+        self.healthcheck = self.base_url + "/healthcheck"
+        self.health_interval = health_interval
+        self.health_ttl = health_ttl
+        self.images_path = Path(images_path)
+        self.images_path.mkdir(parents=True, exist_ok=True)
+
+        # Shared keep-alive connection pool, and a router balancing over the deployments
+        self.session = get_session(token, self.base_url, pool_size=pool_size, http2=http2)
+        self.router = Router(
+            [(url + "/predict", weight) for url, weight in endpoints],
+            token,
+            max_per_endpoint=max_concurrency or pool_size,
+            pool_size=pool_size,
+            http2=http2,
+        )
+        self.thumbnails = ThumbnailPipeline(self.images_path / "thumbs")
+        self.cache = ResultCache(self.images_path, max_bytes=cache_max_bytes, on_evict=self.thumbnails.remove)
+        self.history = History(self.images_path / "history.sqlite")
+        self.tracer = Tracer(jsonl_path=self.images_path / "traces.jsonl")
+        self.coalescer = Coalescer()
+        # Shares the generations in flight fairly between users
+        self.scheduler = scheduler or FairScheduler(max_in_flight=max_concurrency or pool_size)
+        # Variants of one configuration share multi-image requests
+        self.batcher = MicroBatcher(self._generate_batch, window=batch_window, merge_seeds=True)
+        self._monitors: Dict = {}
+        self._job_client = None
+        self._lock = threading.Lock()
+
+    def health_monitor(self, healthcheck_url: Optional[str] = None):
+        """Return the started background monitor of ``healthcheck_url``."""
+        from imagen.health import HealthMonitor
+
+        healthcheck_url = healthcheck_url or self.healthcheck
+        with self._lock:
+            monitor = self._monitors.get(healthcheck_url)
+            if monitor is None:
+                monitor = HealthMonitor(
+                    healthcheck_url, interval=self.health_interval, ttl=self.health_ttl, token=self.token
+                ).start()
+                self._monitors[healthcheck_url] = monitor
+        return monitor
+
+    def image_path(self, cache_key: str, i: int) -> str:
+        return str(self.images_path / f"{cache_key}_octo_{i}.png")
+
+    def cached(self, payload: Dict, count_miss: bool = True) -> Optional[List[str]]:
+        """Return the files of an identical earlier generation, if cached."""
+        return self.cache.get(self.cache.key(payload, self.endpoint), count_miss=count_miss)
+
+    def generate(
+        self,
+        payload: Dict,
+        healthcheck: Optional[str] = None,
+        user: str = "",
+        interactive: bool = True,
+        on_wait: Optional[Callable[[int], None]] = None,
+    ) -> Optional[List[str]]:
+        """Return the image files for ``payload``, generating them if needed.
+
+        The request goes to whichever deployment the router picks; results
+        are cached under the primary endpoint since every deployment serves
+        the same model. Sweeps and other bulk work should pass
+        ``interactive=False`` so they never take the slots kept for
+        interactive requests. ``on_wait`` receives the queue position while
+        waiting for a slot. Returns None when the endpoint is unhealthy.
+        """
+        # Return previously generated images for an identical request
+        cache_key = self.cache.key(payload, self.endpoint)
+        cached_files = self.cache.get(cache_key)
+        if cached_files is not None:
+            return cached_files
+
+        # Share one GPU job between identical seeded requests from every session
+        files, shared = self.coalescer.run(
+            payload, self.endpoint, lambda p: self._generate(p, cache_key, healthcheck, user, interactive, on_wait)
+        )
+        if shared and files:
+            # The files belong to another cache entry, which may evict them
+            files = self.link(cache_key, files)
+            self.cache.put(cache_key, files)
+        return files
+
+    def link(self, cache_key: str, files: List[str]) -> List[str]:
+        """Give ``cache_key`` its own names for images generated under another key."""
+        linked = []
+        for i, source in enumerate(files):
+            target = self.image_path(cache_key, i)
+            if os.path.abspath(source) != os.path.abspath(target):
+                tmp_path = f"{target}.tmp"
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                try:
+                    os.link(source, tmp_path)
+                except OSError:
+                    shutil.copyfile(source, tmp_path)
+                os.replace(tmp_path, target)
+                self.thumbnails.submit(target)
+            linked.append(target)
+        return linked
+
+    def generate_variant(self, payload: Dict, user: str = "") -> Optional[List[str]]:
+        """Generate ``payload`` in a multi-image request shared with its other variants.
+
+        Payloads that differ only in seed and image count are merged, so the
+        images aren't those of the payload's own seed and aren't cached
+        under it; the merged request is cached and recorded as sent. Variants
+        are bulk work and never take the interactive slots.
+        """
+        return self.batcher.run(payload, user)
+
+    def _generate_batch(self, payload: Dict, tags) -> Optional[List[str]]:
+        # The merged request waits for a slot as its first member's user
+        return self.generate(payload, user=tags[0], interactive=False)
+
+    def _generate(
+        self,
+        payload: Dict,
+        cache_key: str,
+        healthcheck: Optional[str],
+        user: str,
+        interactive: bool,
+        on_wait: Optional[Callable[[int], None]],
+    ) -> Optional[List[str]]:
+        from imagen.stream import image_files, stream_to_files
+
+        # With several deployments the router's circuit breakers route around an unhealthy one
+        if len(self.router.endpoints) == 1 and not self.health_monitor(healthcheck).is_healthy():
+            return None
+
+        cost = int(payload.get("num_images", 1))
+        with self.tracer.trace(self.source) as trace, self.scheduler.slot(user, cost, interactive, on_wait) as ticket:
+            # The router records the wait for an endpoint slot as "queue"
+            trace.add("schedule", ticket.wait)
+            # Run inference, streaming the response instead of loading it at once
+            start = time.time()
+            response = self.router.send(json=payload, stream=True, trace=trace)
+            response.raise_for_status()
+
+            # Decode each base64 image straight into its output file
+            metadata = stream_to_files(response, lambda i: self.image_path(cache_key, i), trace=trace)
+            files = image_files(metadata)
+            with trace.phase("record"):
+                self.history.record(payload, files, endpoint=response.url, latency=time.time() - start, source=self.source)
+
+        # Make thumbnails in the background for previews and grids
+        for file in files:
+            self.thumbnails.submit(file)
+
+        self.cache.put(cache_key, files)
+        return files
+
+    def _cache_job_result(self, job):
+        from imagen.jobs import COMPLETED
+
+        # Completed queued jobs land in the result cache like synchronous ones
+        if job.status == COMPLETED:
+            self.history.record(job.payload, job.files, endpoint=job.endpoint, latency=job.elapsed, source=f"{self.source}-queue")
+            for file in job.files:
+                self.thumbnails.submit(file)
+            self.cache.put(job.tag, job.files)
+
+    @property
+    def job_client(self):
+        # One poller tracks the queued jobs of every caller, started on first use
+        from imagen.jobs import JobClient
+
+        with self._lock:
+            if self._job_client is None:
+                self._job_client = JobClient(self.token, session=self.session, on_complete=self._cache_job_result)
+        return self._job_client
+
+    def submit(self, payload: Dict, endpoint: Optional[str] = None):
+        """Queue ``payload`` and return a ``Job`` handle without waiting for it."""
+        from imagen.jobs import Job
+
+        endpoint = endpoint or self.endpoint
+        cache_key = self.cache.key(payload, endpoint)
+        cached_files = self.cache.get(cache_key)
+        if cached_files is not None:
+            return Job.from_files(endpoint, payload, cached_files, tag=cache_key)
+        return self.job_client.submit(endpoint, payload, lambda i: self.image_path(cache_key, i), tag=cache_key)
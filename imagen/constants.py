@@ -0,0 +1,24 @@
+"""Values shared by the app, the example scripts and the tools."""
+
+# Samplers offered in the eval app
+SAMPLERS = [
+    "DPM++2MKarras",
+    "KLMS",
+    "DDIM",
+    "DDPM",
+    "K_EULER",
+    "K_EULER_ANCESTRAL",
+    "DPMSolverMultistep",
+    "PNDM",
+    "DPMSingle",
+    "HEUN",
+    "DPM_2",
+    "DPM2_ANCESTRAL",
+]
+
+# Custom checkpoints, "default" meaning no model key in the payload
+CHECKPOINTS = ["default", "copax-timeless", "crystal-clear", "duchaiten-aiart", "realcartoon", "samaritan"]
+
+# ControlNet canny deployments
+CANNY_A10_URL = "https://control-sdxl2-vvwbynjr46vc.octoai.run/canny"
+CANNY_A100_URL = "https://controlnet-sdxl-a100-vvwbynjr46vc.octoai.run/canny"
@@ -0,0 +1,95 @@
+"""Background endpoint health monitoring with a cached status."""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+def http_probe(url: str, token: Optional[str] = None, timeout: float = 5.0) -> Callable[[], bool]:
+    """Return a probe that GETs ``url`` and reports whether it answered 200.
+
+    The probe goes through the shared session of ``token``, so it sends the
+    bearer token that deployments requiring auth expect.
+    """
+    from imagen.session import get_session
+
+    session = get_session(token, url)
+
+    def probe():
+        return session.get(url, timeout=timeout).status_code == 200
+
+    return probe
+
+
+class HealthMonitor:
+    """Probe an endpoint on an interval and cache the last status.
+
+    ``is_healthy()`` answers from the cache while the last probe succeeded
+    within ``ttl`` seconds, and only probes inline on cold start, after a
+    failure or once the cached status has expired.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        probe: Optional[Callable[[], bool]] = None,
+        interval: float = 30.0,
+        ttl: float = 60.0,
+        token: Optional[str] = None,
+    ):
+        self.url = url
+        self.interval = interval
+        self.ttl = ttl
+        self._probe = probe or http_probe(url, token)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.healthy = None
+        self.checked_at = None
+        self.latency = None
+        self.error = None
+
+    def probe(self) -> bool:
+        """Probe the endpoint now and update the cached status."""
+        start = time.time()
+        try:
+            healthy, error = bool(self._probe()), None
+        except Exception as e:
+            healthy, error = False, str(e)
+        with self._lock:
+            self.healthy = healthy
+            self.error = error
+            self.checked_at = time.time()
+            self.latency = self.checked_at - start
+        return healthy
+
+    def is_healthy(self) -> bool:
+        with self._lock:
+            fresh = self.checked_at is not None and time.time() - self.checked_at < self.ttl
+            if fresh and self.healthy:
+                return True
+        return self.probe()
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "healthy": self.healthy,
+                "checked_at": self.checked_at,
+                "latency": self.latency,
+                "error": self.error,
+            }
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe()
+            self._stop.wait(self.interval)
+
+    def start(self) -> "HealthMonitor":
+        """Start probing on a background daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,228 @@
+"""SQLite index of past generations.
+
+Every generation is recorded with its canonical payload, endpoint, latency,
+timestamp and output paths, so results can be searched by prompt text
+(FTS5), model, LoRA, sampler or seed and reproduced without listing or
+hashing the image directory.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+from imagen.cache import canonical_payload, payload_key
+
+# Input images, too large to store; payloads recorded without them can't be resent as is
+INPUT_FIELDS = ("image", "init_image")
+# Fields only sent along with an input image
+INPUT_ONLY_FIELDS = ("strength", "controlnet_conditioning_scale")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    payload_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    endpoint TEXT,
+    source TEXT,
+    prompt TEXT,
+    prompt_2 TEXT,
+    negative_prompt TEXT,
+    model TEXT,
+    sampler TEXT,
+    seed INTEGER,
+    latency REAL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    generation_id INTEGER NOT NULL REFERENCES generations(id),
+    idx INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (generation_id, idx)
+);
+CREATE TABLE IF NOT EXISTS loras (
+    generation_id INTEGER NOT NULL REFERENCES generations(id),
+    name TEXT NOT NULL,
+    weight REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generations_payload_key ON generations(payload_key);
+CREATE INDEX IF NOT EXISTS generations_model ON generations(model, created_at);
+CREATE INDEX IF NOT EXISTS generations_seed ON generations(seed);
+CREATE INDEX IF NOT EXISTS generations_sampler ON generations(sampler);
+CREATE INDEX IF NOT EXISTS generations_created_at ON generations(created_at);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs(path);
+CREATE INDEX IF NOT EXISTS loras_name ON loras(name, generation_id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+    prompt, prompt_2, negative_prompt, content='generations', content_rowid='id'
+);
+"""
+
+
+def reproducible(payload: Dict) -> bool:
+    """Whether a recorded payload is the whole request, i.e. it had no input image."""
+    return not any(field in payload for field in INPUT_FIELDS + INPUT_ONLY_FIELDS)
+
+
+class History:
+    """Record and search generations in an SQLite database."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            try:
+                self._conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5, fall back to LIKE searches
+                self.fts = False
+
+    def record(
+        self,
+        payload: Dict,
+        files: Sequence[str],
+        endpoint: str = "",
+        latency: Optional[float] = None,
+        source: str = "",
+        created_at: Optional[float] = None,
+    ) -> int:
+        """Record one generation and return its id."""
+        model = payload.get("model")
+        sampler = payload.get("sampler")
+        seed = payload.get("seed")
+        loras = payload.get("loras") or {}
+        # The ControlNet payload has no model and keeps its image in the payload
+        stored = {k: v for k, v in payload.items() if k not in INPUT_FIELDS}
+        row = (
+            payload_key(payload, endpoint),
+            canonical_payload(stored),
+            endpoint,
+            source,
+            payload.get("prompt"),
+            payload.get("prompt_2"),
+            payload.get("negative_prompt"),
+            model,
+            sampler,
+            seed,
+            latency,
+            created_at or time.time(),
+        )
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO generations (payload_key, payload, endpoint, source, prompt, prompt_2, "
+                "negative_prompt, model, sampler, seed, latency, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            generation_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO outputs (generation_id, idx, path) VALUES (?, ?, ?)",
+                [(generation_id, i, str(path)) for i, path in enumerate(files)],
+            )
+            self._conn.executemany(
+                "INSERT INTO loras (generation_id, name, weight) VALUES (?, ?, ?)",
+                [(generation_id, name, weight) for name, weight in loras.items()],
+            )
+            if self.fts:
+                self._conn.execute(
+                    "INSERT INTO generations_fts (rowid, prompt, prompt_2, negative_prompt) VALUES (?, ?, ?, ?)",
+                    (generation_id, row[4], row[5], row[6]),
+                )
+        return generation_id
+
+    def _rows_to_dicts(self, rows) -> List[Dict]:
+        results = [dict(row) for row in rows]
+        if not results:
+            return results
+        ids = [r["id"] for r in results]
+        placeholders = ",".join("?" * len(ids))
+        outputs = {}
+        with self._lock:
+            for row in self._conn.execute(
+                f"SELECT generation_id, path FROM outputs WHERE generation_id IN ({placeholders}) ORDER BY generation_id, idx",
+                ids,
+            ):
+                outputs.setdefault(row["generation_id"], []).append(row["path"])
+        for result in results:
+            result["payload"] = json.loads(result["payload"])
+            result["files"] = outputs.get(result["id"], [])
+        return results
+
+    def search(
+        self,
+        text: Optional[str] = None,
+        model: Optional[str] = None,
+        lora: Optional[str] = None,
+        sampler: Optional[str] = None,
+        seed: Optional[int] = None,
+        limit: int = 50,
+        offset: int = 0,
+    ) -> List[Dict]:
+        """Return the newest generations matching all the given filters.
+
+        ``text`` is an FTS5 query over the prompts, e.g. ``cat AND fishbowl``.
+        """
+        where, params = [], []
+        if text:
+            if self.fts:
+                where.append("g.id IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)")
+                params.append(text)
+            else:
+                where.append("(g.prompt LIKE ? OR g.prompt_2 LIKE ? OR g.negative_prompt LIKE ?)")
+                params.extend([f"%{text}%"] * 3)
+        if model:
+            where.append("g.model = ?")
+            params.append(model)
+        if lora:
+            where.append("g.id IN (SELECT generation_id FROM loras WHERE name = ? AND weight != 0)")
+            params.append(lora)
+        if sampler:
+            where.append("g.sampler = ?")
+            params.append(sampler)
+        if seed is not None:
+            where.append("g.seed = ?")
+            params.append(seed)
+        query = "SELECT g.* FROM generations g"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY g.created_at DESC LIMIT ? OFFSET ?"
+        with self._lock:
+            rows = self._conn.execute(query, params + [limit, offset]).fetchall()
+        return self._rows_to_dicts(rows)
+
+    def get(self, generation_id: int) -> Optional[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM generations WHERE id = ?", (generation_id,)).fetchall()
+        results = self._rows_to_dicts(rows)
+        return results[0] if results else None
+
+    def by_output(self, path) -> Optional[Dict]:
+        """Return the generation that produced the image at ``path``."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT g.* FROM generations g JOIN outputs o ON o.generation_id = g.id WHERE o.path = ? "
+                "ORDER BY g.created_at DESC LIMIT 1",
+                (str(path),),
+            ).fetchall()
+        results = self._rows_to_dicts(rows)
+        return results[0] if results else None
+
+    def replace_path(self, old, new):
+        """Point the outputs recorded at ``old`` to ``new``, e.g. when a planned file was never written."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE outputs SET path = ? WHERE path = ?", (str(new), str(old)))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
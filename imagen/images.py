@@ -0,0 +1,250 @@
+"""Helpers for preparing input images for the image endpoints.
+
+``prepare_image`` is the preprocessing stage for img2img ``init_image`` and
+ControlNet ``image`` inputs: it resizes the input to the supported
+generation resolution it will be used at, optionally computes the canny
+edge map locally, and sends whichever encoding is smallest. Large photos
+are then uploaded at a fraction of their native size instead of being
+resized server side.
+"""
+
+import base64
+import io
+import os
+import struct
+from functools import lru_cache, partial
+from typing import List, Optional, Sequence, Tuple, Union
+
+from imagen.validation import nearest_resolution
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+# JPEG start of frame markers, the segment holding the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _upload_bytes(data: bytes) -> bytes:
+    # PNGs and JPEGs go as they are, anything else is re-encoded as PNG
+    if data.startswith(PNG_SIGNATURE) or data.startswith(JPEG_SIGNATURE):
+        return data
+    import PIL.Image
+
+    image = PIL.Image.open(io.BytesIO(data))
+    image_buffer = io.BytesIO()
+    image.save(image_buffer, format="PNG")
+    return image_buffer.getvalue()
+
+
+@lru_cache(maxsize=64)
+def _encode_cached(path: str, mtime_ns: int, size: int) -> str:
+    with open(path, "rb") as f:
+        data = f.read()
+    return base64.b64encode(_upload_bytes(data)).decode("utf-8")
+
+
+def encode_image_file(path) -> str:
+    """Return the base64 encoding of the image at ``path``.
+
+    Results are cached by path, modification time and size, so sweeping many
+    prompts over one control image encodes it only once. PNG and JPEG files
+    are sent as is without a decode/re-encode round trip, others as PNG.
+    """
+    stat = os.stat(path)
+    return _encode_cached(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def image_size(f) -> Optional[Tuple[int, int]]:
+    """Return the ``(width, height)`` of the PNG or JPEG in the binary file ``f``.
+
+    Only the header is read, without decoding the image or importing
+    Pillow. Returns None for other formats and headers it can't parse.
+    """
+    head = f.read(24)
+    if head.startswith(PNG_SIGNATURE):
+        # IHDR is always the first chunk
+        if len(head) < 24 or head[12:16] != b"IHDR":
+            return None
+        return struct.unpack(">II", head[16:24])
+    if not head.startswith(JPEG_SIGNATURE):
+        return None
+    f.seek(2 - len(head), os.SEEK_CUR)
+    while True:
+        byte = f.read(1)
+        if byte != b"\xff":
+            return None
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        # Markers without a segment
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0]
+        if marker in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame[1:5])
+            return width, height
+        if marker == 0xD9 or length < 2:
+            return None
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def fit_to_resolution(image, resolution: Tuple[int, int]):
+    """Scale ``image`` to cover ``resolution`` and center crop the overflow."""
+    import PIL.Image
+    import PIL.ImageOps
+
+    if image.size == tuple(resolution):
+        return image
+    return PIL.ImageOps.fit(image, resolution, method=PIL.Image.LANCZOS)
+
+
+def canny_edges(image, low_threshold: int = 100, high_threshold: int = 200):
+    """Return the canny edge map of ``image`` as a black and white image.
+
+    Uses OpenCV when it is installed. Otherwise edges are approximated with
+    Pillow (blur, edge filter, threshold at ``low_threshold``), which is close
+    enough for conditioning but not identical to canny.
+    """
+    import PIL.Image
+    import PIL.ImageFilter
+
+    gray = image.convert("L")
+    try:
+        import cv2
+        import numpy as np
+    except ImportError:
+        edges = gray.filter(PIL.ImageFilter.GaussianBlur(1)).filter(PIL.ImageFilter.FIND_EDGES)
+        return edges.point(lambda v: 255 if v >= low_threshold else 0).convert("1")
+    edges = cv2.Canny(np.asarray(gray), low_threshold, high_threshold)
+    return PIL.Image.fromarray(edges).convert("1")
+
+
+def encode_smallest(image, formats: Sequence[str] = ("PNG", "JPEG"), quality: int = 90) -> Tuple[str, bytes]:
+    """Encode ``image`` in each of ``formats`` and return the smallest ``(format, data)``.
+
+    JPEG is skipped for images with transparency and for black and white
+    edge maps, which are both better served lossless.
+    """
+    best = None
+    for image_format in formats:
+        if image_format == "JPEG" and (image.mode in ("1", "RGBA", "LA") or "transparency" in image.info):
+            continue
+        buffer = io.BytesIO()
+        if image_format == "JPEG":
+            image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+        elif image_format == "PNG":
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format=image_format, quality=quality)
+        if best is None or buffer.tell() < len(best[1]):
+            best = (image_format, buffer.getvalue())
+    return best
+
+
+def prepare_image(
+    source: Union[str, os.PathLike, bytes],
+    resolution: Optional[Tuple[int, int]] = None,
+    canny: bool = False,
+    low_threshold: int = 100,
+    high_threshold: int = 200,
+    formats: Sequence[str] = ("PNG", "JPEG"),
+    quality: int = 90,
+) -> str:
+    """Return the base64 upload of an img2img or ControlNet input image.
+
+    ``source`` is a file path or the raw image bytes. The image is fit to
+    ``resolution``, or to the supported resolution nearest its own shape,
+    turned into a canny edge map when ``canny`` is set, and encoded in
+    whichever of ``formats`` is smallest. PNGs and JPEGs that already fit the
+    target and need no edge map are sent as they are, sized from their
+    header without decoding them or importing Pillow; other formats that
+    fit go as PNG without resizing. Files are prepared once per path, modification
+    time, size and options, so requests reusing one control image don't
+    redo the work.
+    """
+    options = (tuple(resolution) if resolution else None, canny, low_threshold, high_threshold, tuple(formats), quality)
+    if isinstance(source, bytes):
+        if not canny and _fits(image_size(io.BytesIO(source)), resolution):
+            return base64.b64encode(source).decode("utf-8")
+        return _prepare(source, *options)
+    if not canny:
+        with open(source, "rb") as f:
+            size = image_size(f)
+        if _fits(size, resolution):
+            return encode_image_file(source)
+    stat = os.stat(source)
+    return _prepare_file(os.path.abspath(source), stat.st_mtime_ns, stat.st_size, *options)
+
+
+def _fits(size: Optional[Tuple[int, int]], resolution: Optional[Tuple[int, int]]) -> bool:
+    # Inputs at or below the target size are never scaled up, the server handles those
+    if size is None:
+        return False
+    width, height = resolution or nearest_resolution(*size)
+    return size[0] <= width and size[1] <= height
+
+
+@lru_cache(maxsize=64)
+def _prepare_file(path: str, mtime_ns: int, size: int, *options) -> str:
+    with open(path, "rb") as f:
+        return _prepare(f.read(), *options)
+
+
+def _prepare(
+    source: bytes,
+    resolution: Optional[Tuple[int, int]] = None,
+    canny: bool = False,
+    low_threshold: int = 100,
+    high_threshold: int = 200,
+    formats: Sequence[str] = ("PNG", "JPEG"),
+    quality: int = 90,
+) -> str:
+    import PIL.Image
+
+    with PIL.Image.open(io.BytesIO(source)) as image:
+        resolution = tuple(resolution or nearest_resolution(*image.size))
+        if not canny and _fits(image.size, resolution):
+            return base64.b64encode(_upload_bytes(source)).decode("utf-8")
+        # Let JPEG decode at a reduced scale when the source is much larger than the target
+        image.draft("RGB", resolution)
+        image.load()
+
+    # Palette and other modes would be resized with nearest neighbour sampling
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    image = fit_to_resolution(image, resolution)
+    if canny:
+        image = canny_edges(image, low_threshold, high_threshold)
+    _, data = encode_smallest(image, formats, quality)
+    return base64.b64encode(data).decode("utf-8")
+
+
+def prepare_images(
+    sources: Sequence,
+    resolutions: Optional[Sequence[Tuple[int, int]]] = None,
+    workers: Optional[int] = None,
+    **kwargs,
+) -> List[str]:
+    """Run ``prepare_image`` over many inputs in a process pool.
+
+    Decoding, resizing and encoding are CPU bound, so batches are spread
+    over processes instead of threads. ``resolutions`` optionally gives the
+    target of each input; other keyword arguments go to ``prepare_image``.
+    Returns the encodings in input order.
+    """
+    resolutions = list(resolutions) if resolutions is not None else [None] * len(sources)
+    if len(sources) <= 1:
+        return [prepare_image(source, resolution, **kwargs) for source, resolution in zip(sources, resolutions)]
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(prepare_image, **kwargs), sources, resolutions))
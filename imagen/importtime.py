@@ -0,0 +1,151 @@
+"""Cold start import benchmark for the scripts and the app's client.
+
+Run with ``python -m imagen.importtime``. Each target module is imported in
+a fresh interpreter under ``python -X importtime`` ``--runs`` times and the
+fastest run is kept, so the numbers are the import cost alone, without
+noise from the rest of the machine::
+
+    python -m imagen.importtime --runs 5 --out importtime.csv
+
+Every target has a budget in milliseconds and a set of heavy modules it
+must not import (Pillow, NumPy, OpenCV, Streamlit, the OctoAI SDK, ...).
+The command exits non-zero when a target goes over its budget or imports a
+forbidden module, so it can run in CI as a regression test. ``--scale``
+multiplies the budgets for slower machines.
+"""
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Sequence
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only some code paths need, which must never load at startup
+HEAVY = ("PIL", "numpy", "cv2", "streamlit", "octoai", "pydantic", "yaml", "httpx", "pandas")
+
+# Target module -> import budget in milliseconds. Targets that send
+# requests pay for ``requests`` itself, about 100ms of the budget, the
+# others defer it until they are used
+BUDGETS = {
+    "imagen.batch": 250,
+    "imagen.router": 250,
+    "imagen.client": 60,
+    "imagen.images": 40,
+    "imagen.manifest": 40,
+    "imagen.output": 40,
+    "imagen.stream": 40,
+    "imagen.tracing": 40,
+    "imagen.validation": 40,
+}
+
+# Targets that must not import ``requests`` either
+OFFLINE = ("imagen.client", "imagen.images", "imagen.manifest", "imagen.output", "imagen.stream", "imagen.tracing", "imagen.validation")
+
+RESULT_FIELDS = ["module", "ms", "budget_ms", "modules", "slowest"]
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """Return the cumulative microseconds of every module in ``-X importtime`` output."""
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, _, fields = line.partition(":")
+        parts = fields.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            # The header line
+            continue
+        cumulative[parts[2].strip()] = int(parts[1])
+    return cumulative
+
+
+def _importtime(code: str, python: str) -> Dict[str, int]:
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))}
+    result = subprocess.run([python, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=REPO_ROOT, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"{code!r} failed: {result.stderr.strip().splitlines()[-1]}")
+    return parse_importtime(result.stderr)
+
+
+def measure(module: str, runs: int = 5, python: str = sys.executable) -> Dict:
+    """Import ``module`` in ``runs`` fresh interpreters and keep the fastest."""
+    # Modules every interpreter imports on startup (site, encodings, ...)
+    startup = set(_importtime("pass", python))
+    best = None
+    for _ in range(runs):
+        cumulative = _importtime(f"import {module}", python)
+        if module not in cumulative:
+            raise RuntimeError(f"{module} was already imported on interpreter startup")
+        if best is None or cumulative[module] < best[module]:
+            best = cumulative
+    imported = {name: us for name, us in best.items() if name not in startup}
+    slowest = sorted((name for name in imported if name != module), key=imported.get, reverse=True)[:5]
+    return {
+        "module": module,
+        "ms": best[module] / 1000,
+        "modules": sorted(imported),
+        "slowest": [(name, imported[name] / 1000) for name in slowest],
+    }
+
+
+def check(result: Dict, budget_ms: Optional[float], forbidden: Sequence[str]) -> List[str]:
+    """Return what is wrong with one measurement, if anything."""
+    problems = []
+    if budget_ms is not None and result["ms"] > budget_ms:
+        problems.append(f"{result['module']} took {result['ms']:.1f}ms, over its {budget_ms:.0f}ms budget")
+    for name in result["modules"]:
+        if name.split(".")[0] in forbidden:
+            problems.append(f"{result['module']} imports {name}")
+    return problems
+
+
+def write_results(results: List[Dict], path: str):
+    # Append so the file tracks cold start over time
+    new = not os.path.exists(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new:
+            writer.writeheader()
+        for result in results:
+            writer.writerow({
+                "module": result["module"],
+                "ms": f"{result['ms']:.2f}",
+                "budget_ms": result["budget_ms"],
+                "modules": len(result["modules"]),
+                "slowest": " ".join(f"{name}={ms:.1f}" for name, ms in result["slowest"]),
+            })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and check the cold start import time of imagen modules")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS), help="Modules to import (default: every budgeted one)")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module, the fastest counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget, e.g. on slow CI machines")
+    parser.add_argument("--out", help="Append results to this CSV file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results, problems = [], []
+    for module in args.modules:
+        result = measure(module, runs=args.runs)
+        budget = BUDGETS.get(module)
+        result["budget_ms"] = budget * args.scale if budget is not None else None
+        forbidden = HEAVY + (("requests", "urllib3") if module in OFFLINE else ())
+        problems += check(result, result["budget_ms"], forbidden)
+        slowest = ", ".join(f"{name} {ms:.1f}ms" for name, ms in result["slowest"][:3])
+        print(f"{module:<20} {result['ms']:7.1f}ms  {len(result['modules']):4} modules  slowest: {slowest}")
+        results.append(result)
+    if args.out:
+        write_results(results, args.out)
+    for problem in problems:
+        print(f"FAIL: {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
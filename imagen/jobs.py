@@ -0,0 +1,210 @@
+"""Asynchronous job submission and polling for long generations.
+
+Requests sent with the ``X-OctoAI-Async`` header return immediately with a
+``response_id`` and a ``poll_url``. Polling that URL reports the job status
+and, once completed, a ``response_url`` holding the usual response body.
+``JobClient`` submits jobs, tracks any number of outstanding ones on a single
+poller thread and delivers results through callbacks or ``as_completed``.
+"""
+
+import itertools
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+ASYNC_HEADER = "X-OctoAI-Async"
+
+PENDING = "pending"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class Job:
+    """Handle for a submitted generation."""
+
+    _ids = itertools.count()
+
+    def __init__(self, endpoint: str, payload: Dict, image_path: Optional[Callable[[int], str]], tag=None):
+        self.id = next(self._ids)
+        self.endpoint = endpoint
+        self.payload = payload
+        self.image_path = image_path
+        self.tag = tag
+        self.response_id = None
+        self.poll_url = None
+        self.status = PENDING
+        self.files: List[str] = []
+        self.error = None
+        self.submitted_at = time.time()
+        self.completed_at = None
+        self.next_poll = 0.0
+        self.interval = 0.0
+        self._done = threading.Event()
+
+    @classmethod
+    def from_files(cls, endpoint: str, payload: Dict, files: List[str], tag=None) -> "Job":
+        """Return an already completed job, e.g. for a cached result."""
+        job = cls(endpoint, payload, None, tag)
+        job.files = list(files)
+        job.status = COMPLETED
+        job.completed_at = job.submitted_at
+        job._done.set()
+        return job
+
+    @property
+    def done(self) -> bool:
+        return self.status != PENDING
+
+    @property
+    def elapsed(self) -> float:
+        return (self.completed_at or time.time()) - self.submitted_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class JobClient:
+    """Submit async jobs and poll them with adaptive intervals.
+
+    The first poll of a job is scheduled shortly before the expected duration
+    (an EWMA of past job durations), after which the interval grows by
+    ``backoff`` from ``poll_min`` up to ``poll_max``. Every request waits
+    at most ``timeout`` seconds for the server, so one stuck connection
+    can't hold up the poller and the jobs behind it; a status poll that
+    times out is tried again at the next interval.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str],
+        session=None,
+        poll_min: float = 0.5,
+        poll_max: float = 10.0,
+        backoff: float = 1.5,
+        on_complete: Optional[Callable[[Job], None]] = None,
+        timeout: float = 30.0,
+    ):
+        if session is None:
+            from imagen.session import make_session
+
+            session = make_session()
+        self.session = session
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.backoff = backoff
+        self.on_complete = on_complete
+        self.timeout = timeout
+        self.expected_duration = None
+        self._jobs: Dict[int, Job] = {}
+        self._completed = queue.Queue()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def submit(self, endpoint: str, payload: Dict, image_path: Callable[[int], str], tag=None) -> Job:
+        """Submit ``payload`` and return its job handle without waiting."""
+        job = Job(endpoint, payload, image_path, tag)
+        response = self.session.post(endpoint, json=payload, headers={**self.headers, ASYNC_HEADER: "1"}, timeout=self.timeout)
+        if response.status_code not in (200, 201, 202):
+            self._finish(job, FAILED, error=f"Submit failed with status code {response.status_code}: {response.text[:200]}")
+            return job
+        reply = response.json()
+        job.response_id = reply["response_id"]
+        job.poll_url = reply["poll_url"]
+        job.interval = self.poll_min
+        job.next_poll = time.time() + max(self.poll_min, 0.9 * (self.expected_duration or 0.0))
+        with self._lock:
+            self._jobs[job.id] = job
+        self._ensure_poller()
+        self._wakeup.set()
+        return job
+
+    def pending(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def as_completed(self, jobs: Optional[Iterable[Job]] = None, timeout: Optional[float] = None) -> Iterator[Job]:
+        """Yield jobs as they finish, in completion order.
+
+        With ``jobs`` given, waits for exactly those; otherwise yields every
+        job completed by this client until ``timeout`` passes with nothing new.
+        """
+        if jobs is not None:
+            remaining = {job.id: job for job in jobs}
+            deadline = None if timeout is None else time.time() + timeout
+            while remaining:
+                for job in list(remaining.values()):
+                    if job.done:
+                        yield remaining.pop(job.id)
+                if remaining:
+                    if deadline is not None and time.time() >= deadline:
+                        return
+                    next(iter(remaining.values())).wait(0.05)
+            return
+        while True:
+            try:
+                yield self._completed.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def _finish(self, job: Job, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.completed_at = time.time()
+        with self._lock:
+            self._jobs.pop(job.id, None)
+            if status == COMPLETED:
+                # Track typical job duration to time the first poll of new jobs
+                if self.expected_duration is None:
+                    self.expected_duration = job.elapsed
+                else:
+                    self.expected_duration = 0.8 * self.expected_duration + 0.2 * job.elapsed
+        job._done.set()
+        self._completed.put(job)
+        if self.on_complete is not None:
+            self.on_complete(job)
+
+    def _poll(self, job: Job):
+        from requests.exceptions import Timeout
+
+        from imagen.stream import image_files, stream_to_files
+
+        try:
+            try:
+                reply = self.session.get(job.poll_url, headers=self.headers, timeout=self.timeout).json()
+            except Timeout:
+                reply = {}
+            status = reply.get("status", PENDING)
+            if status == COMPLETED:
+                response = self.session.get(reply["response_url"], headers=self.headers, stream=True, timeout=self.timeout)
+                response.raise_for_status()
+                job.files = image_files(stream_to_files(response, job.image_path))
+                self._finish(job, COMPLETED)
+                return
+            if status == FAILED:
+                self._finish(job, FAILED, error=reply.get("error", "Job failed"))
+                return
+        except Exception as e:
+            self._finish(job, FAILED, error=str(e))
+            return
+        job.next_poll = time.time() + job.interval
+        job.interval = min(self.poll_max, job.interval * self.backoff)
+
+    def _run(self):
+        while True:
+            now = time.time()
+            due = [job for job in self.pending() if job.next_poll <= now]
+            for job in due:
+                self._poll(job)
+            pending = self.pending()
+            delay = min((job.next_poll for job in pending), default=now + self.poll_max) - time.time()
+            self._wakeup.wait(max(0.0, delay))
+            self._wakeup.clear()
+
+    def _ensure_poller(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job-poller", daemon=True)
+                self._thread.start()
@@ -0,0 +1,241 @@
+"""Adaptive concurrency control for requests to a provisioned endpoint.
+
+``AdaptiveLimiter`` caps the number of requests in flight with an AIMD
+(additive increase, multiplicative decrease) limit: the limit grows by about
+one request per round trip while latency stays near its baseline, and is cut
+on 429/503 responses or latency spikes. ``Retry-After`` pauses every caller
+until the server asks to be retried. ``send`` puts the limiter and retries
+in the request path of any session.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+
+# Status codes worth retrying: throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Status codes meaning the endpoint is over capacity
+THROTTLE_STATUSES = {429, 503}
+
+# Seconds to connect and to wait for the server between bytes, so a stalled
+# connection can't hang a worker; pass ``timeout`` to ``send`` to change it
+DEFAULT_TIMEOUT = (10.0, 300.0)
+
+
+def retry_after(response) -> Optional[float]:
+    """Return the ``Retry-After`` seconds of ``response``, if it sent any.
+
+    Handles both the delay-seconds and the HTTP-date form.
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def retry_delay(attempt: int, backoff: float, response=None) -> float:
+    # Honor Retry-After when the server sends one, otherwise back off exponentially
+    delay = retry_after(response)
+    if delay is not None:
+        return delay
+    return backoff * 2**attempt * (1 + random.random() * 0.1)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent requests driven by latency and throttling.
+
+    ``latency_tolerance`` is how many times the baseline latency may grow to
+    before it counts as a spike. The baseline is the lowest smoothed latency
+    of the last one to two ``baseline_window`` seconds, so queueing that
+    builds up slowly is still measured against the uncongested latency,
+    while an endpoint that really got slower sets a new baseline once the
+    window passes. The limit is cut at most once per round trip so one
+    burst of slow responses doesn't collapse it to the minimum.
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        decrease: float = 0.7,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        baseline_window: float = 300.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.baseline_window = baseline_window
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline = None
+        self.latency = None
+        self.throttled = 0
+        self.completed = 0
+        self.resume_at = 0.0
+        self._last_decrease = 0.0
+        # Lowest smoothed latency of the current and the previous window
+        self._window_start = time.time()
+        self._window_min = None
+        self._previous_min = None
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a free slot, returning False if ``timeout`` expires first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.time()
+                    if now >= self.resume_at and self.in_flight < int(self.limit):
+                        self.in_flight += 1
+                        return True
+                    wait = self.resume_at - now if now < self.resume_at else None
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        wait = min(wait or deadline - now, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency: Optional[float] = None, status: Optional[int] = None, delay: Optional[float] = None):
+        """Free a slot and adapt the limit to how the request went.
+
+        ``latency`` is None for requests that failed without a response.
+        ``delay`` is the ``Retry-After`` of a throttled response.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.time()
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self._decrease(now)
+                if delay:
+                    self.resume_at = max(self.resume_at, now + delay)
+            elif latency is not None and status is not None and status < 500:
+                self.completed += 1
+                self._observe(latency, now)
+            self._cond.notify_all()
+
+    def _observe(self, latency: float, now: float):
+        if self.latency is None:
+            self.latency = self.baseline = self._window_min = latency
+            return
+        # Compare smoothed latency so ordinary jitter doesn't look like a spike
+        self.latency += self.smoothing * (latency - self.latency)
+        if now - self._window_start >= self.baseline_window:
+            self._window_start = now
+            self._previous_min, self._window_min = self._window_min, self.latency
+        else:
+            self._window_min = min(self._window_min, self.latency)
+        self.baseline = self._window_min
+        if self._previous_min is not None:
+            self.baseline = min(self.baseline, self._previous_min)
+        if self.latency > self.baseline * self.latency_tolerance:
+            self._decrease(now)
+        elif self.in_flight + 1 >= int(self.limit):
+            # Only grow while the current limit is actually in use
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+
+    def _decrease(self, now: float):
+        if now - self._last_decrease < (self.latency or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit * self.decrease, self.min_limit)
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for one request; call ``record(response)`` before leaving.
+
+        Leaving without a recorded response (e.g. on a connection error)
+        releases the slot without adapting the limit.
+        """
+        self.acquire()
+        start = time.time()
+        outcome = {}
+
+        def record(response):
+            outcome["latency"] = time.time() - start
+            outcome["status"] = response.status_code
+            outcome["delay"] = retry_after(response)
+
+        try:
+            yield record
+        finally:
+            self.release(outcome.get("latency"), outcome.get("status"), outcome.get("delay"))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "throttled": self.throttled,
+                "completed": self.completed,
+                "latency": self.latency,
+                "baseline_latency": self.baseline,
+            }
+
+
+def send(
+    session,
+    url: str,
+    limiter: Optional[AdaptiveLimiter] = None,
+    max_retries: int = 5,
+    backoff: float = 1.0,
+    method: str = "POST",
+    trace=None,
+    **kwargs,
+):
+    """Send a request through ``limiter``, retrying on 429/5xx and connection errors.
+
+    Returns the last response, which may still be an error once the retries
+    are used up. ``trace`` (an ``imagen.tracing.Trace``) records the time
+    spent waiting for a slot, in the request and between retries. Other
+    keyword arguments go to ``session.request``; ``timeout`` defaults to
+    ``DEFAULT_TIMEOUT``.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    for attempt in range(max_retries + 1):
+        response = None
+        try:
+            start = time.perf_counter()
+            if limiter is None:
+                response = session.request(method, url, **kwargs)
+            else:
+                with limiter.slot() as record:
+                    if trace is not None:
+                        trace.add("queue", time.perf_counter() - start)
+                        start = time.perf_counter()
+                    response = session.request(method, url, **kwargs)
+                    record(response)
+            if trace is not None:
+                trace.response(response, time.perf_counter() - start)
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+            response.close()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+        delay = retry_delay(attempt, backoff, response)
+        if trace is not None:
+            trace.add("retry_wait", delay)
+        time.sleep(delay)
@@ -0,0 +1,126 @@
+"""Append-only manifest of batch jobs, for resuming interrupted runs.
+
+Every finished job appends one JSON line with its id, the hash of its
+payload, its status, output files and latency. On restart the manifest is
+read once into memory and jobs whose latest entry is ``done`` with the same
+payload hash and whose files still exist are skipped; failed and missing jobs
+run again. Lines are flushed to the OS straight away and fsynced in batches,
+so a process crash loses nothing and a power loss at most the last
+``sync_every`` entries, which then simply run again.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from imagen.cache import payload_key
+
+DONE = "done"
+FAILED = "failed"
+
+
+class Manifest:
+    """Record the outcome of each job of a batch in a JSON lines file."""
+
+    def __init__(self, path, sync_every: int = 64, sync_interval: float = 1.0):
+        self.path = str(path)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # job id -> latest entry, and the payload hash of each job this run
+        self.entries: Dict[str, Dict] = self._load()
+        self._keys: Dict[str, str] = {}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a")
+        if self._torn:
+            # Finish the line cut short so the next entry starts on its own
+            self._file.write("\n")
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def _load(self) -> Dict[str, Dict]:
+        entries = {}
+        self._torn = False
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                entries[entry["id"]] = entry
+        return entries
+
+    def completed(self, job_id: str, key: str) -> bool:
+        """Whether ``job_id`` already finished with the payload hashed to ``key``."""
+        entry = self.entries.get(job_id)
+        return (
+            entry is not None
+            and entry["status"] == DONE
+            and entry["key"] == key
+            and all(os.path.exists(f) for f in entry["files"])
+        )
+
+    def pending(self, jobs: Iterable[Tuple[str, Dict]]) -> Iterator[Tuple[str, Dict]]:
+        """Yield the jobs that haven't completed yet.
+
+        Each job is hashed as given here, before any later changes to its
+        payload such as encoding its init image, and recorded under that hash.
+        """
+        for job_id, payload in jobs:
+            key = payload_key(payload)
+            if not self.completed(job_id, key):
+                self._keys[job_id] = key
+                yield job_id, payload
+
+    def record(
+        self,
+        job_id: str,
+        payload: Dict,
+        status: str,
+        files: Optional[List[str]] = None,
+        latency: Optional[float] = None,
+        error: Optional[str] = None,
+    ):
+        """Append the outcome of ``job_id``."""
+        entry = {
+            "id": job_id,
+            "key": self._keys.get(job_id) or payload_key(payload),
+            "status": status,
+            "files": files or [],
+            "latency": latency,
+            "error": error,
+            "finished_at": time.time(),
+        }
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.entries[job_id] = entry
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.time() - self._synced_at >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._unsynced:
+                self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
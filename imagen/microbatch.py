@@ -0,0 +1,170 @@
+"""Micro-batching of variant requests into multi-image requests.
+
+Callers often send one request per variant of an otherwise identical
+configuration. ``MicroBatcher`` holds each request for a short ``window``,
+groups the ones whose payloads differ only in their image count, sends each
+group as a single request for the sum of their images (up to the server's
+``MAX_NUM_IMAGES``) and hands every caller its share of the images. One round
+trip then fills the GPU batch instead of several.
+
+A request for ``n`` images from a seed can't be split back into requests
+for other seeds, so only payloads without a ``seed`` are grouped by default.
+With ``merge_seeds`` payloads that differ in seed are grouped too and the
+group is sent with the first member's seed: the seed becomes a variant label
+rather than a way to reproduce an image, which suits seed sweeps that only
+want several variants.
+"""
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from imagen.cache import payload_key
+from imagen.validation import MAX_NUM_IMAGES
+
+# Seconds a request waits for others to share its batch
+DEFAULT_WINDOW = 0.05
+
+
+class _Group:
+    def __init__(self, key: str, payload: Dict):
+        self.key = key
+        self.payload = payload
+        self.members: List[Tuple[int, Any, Future]] = []
+        self.num_images = 0
+        self.timer = None
+
+
+class MicroBatcher:
+    """Group variant requests arriving within ``window`` seconds.
+
+    ``send(payload, tags)`` issues one request and returns its image files
+    in order; ``tags`` are the ``tag`` of each grouped request, e.g. to name
+    the files after the callers they go back to. It runs on the thread that
+    filled the group or on a timer thread once the window closes.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Dict, Sequence[Any]], List[str]],
+        window: float = DEFAULT_WINDOW,
+        max_images: int = MAX_NUM_IMAGES,
+        num_images_key: str = "num_images",
+        merge_seeds: bool = False,
+    ):
+        self.send = send
+        self.window = window
+        self.max_images = max_images
+        self.num_images_key = num_images_key
+        self.merge_seeds = merge_seeds
+        self._lock = threading.Lock()
+        self._open: Dict[str, _Group] = {}
+        self.requests = 0
+        self.batched = 0
+        self.images = 0
+
+    def _key(self, payload: Dict) -> Optional[str]:
+        # Requests with the same key differ only in image count (and seed)
+        if "seed" in payload and not self.merge_seeds:
+            return None
+        ignored = (self.num_images_key, "seed")
+        return payload_key({k: v for k, v in payload.items() if k not in ignored})
+
+    def submit(self, payload: Dict, tag: Any = None) -> Future:
+        """Queue ``payload`` and return a future of its image files."""
+        num_images = int(payload.get(self.num_images_key, 1))
+        future = Future()
+        key = self._key(payload)
+        if key is None or self.window <= 0 or num_images >= self.max_images:
+            self._send([(num_images, tag, future)], payload)
+            return future
+
+        full = None
+        with self._lock:
+            group = self._open.get(key)
+            if group is not None and group.num_images + num_images > self.max_images:
+                # Doesn't fit, send the open group now and start another
+                full = self._close(group)
+                group = None
+            if group is None:
+                group = _Group(key, payload)
+                group.timer = threading.Timer(self.window, self._expire, args=(group,))
+                group.timer.daemon = True
+                self._open[key] = group
+                group.timer.start()
+            group.members.append((num_images, tag, future))
+            group.num_images += num_images
+            if group.num_images == self.max_images:
+                ready = self._close(group)
+            else:
+                ready = None
+        if full is not None:
+            self._send_group(full)
+        if ready is not None:
+            self._send_group(ready)
+        return future
+
+    def run(self, payload: Dict, tag: Any = None) -> List[str]:
+        """Submit ``payload`` and wait for its files."""
+        return self.submit(payload, tag).result()
+
+    def _close(self, group: _Group) -> _Group:
+        # Called with the lock held
+        group.timer.cancel()
+        del self._open[group.key]
+        return group
+
+    def _expire(self, group: _Group):
+        with self._lock:
+            if self._open.get(group.key) is not group:
+                return
+            self._close(group)
+        self._send_group(group)
+
+    def _send_group(self, group: _Group):
+        self._send(group.members, group.payload)
+
+    def _send(self, members: List[Tuple[int, Any, Future]], payload: Dict):
+        num_images = sum(n for n, _, _ in members)
+        if len(members) > 1:
+            payload = {**payload, self.num_images_key: num_images}
+        with self._lock:
+            self.requests += 1
+            self.batched += len(members)
+        try:
+            files = self.send(payload, [tag for _, tag, _ in members])
+        except BaseException as e:
+            for _, _, future in members:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.images += len(files or [])
+        if len(members) == 1:
+            members[0][2].set_result(files)
+            return
+        files = files or []
+        # Fan the images back out in the order the requests arrived
+        offset = 0
+        for n, _, future in members:
+            share = files[offset:offset + n]
+            offset += n
+            if len(share) == n:
+                future.set_result(share)
+            else:
+                future.set_exception(RuntimeError(f"Expected {n} image(s) from a batch of {num_images}, got {len(share)}"))
+
+    def flush(self):
+        """Send every open group now."""
+        with self._lock:
+            groups = [self._close(group) for group in list(self._open.values())]
+        for group in groups:
+            self._send_group(group)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "batched": self.batched,
+                "images": self.images,
+                "open": len(self._open),
+            }
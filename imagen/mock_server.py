@@ -0,0 +1,332 @@
+"""Local stand-in for the OctoAI image endpoints.
+
+Implements ``/predict``, ``/healthcheck`` and ``/canny`` with the request and
+response shapes documented in ``octoml_sd_api_docs/``, returning solid colour
+placeholder PNGs of the requested size. Requests sent with the
+``X-OctoAI-Async`` header are queued and can be polled under ``/responses/``.
+Latency, errors and 429s can be injected so clients can be load tested and
+profiled offline::
+
+    python -m imagen.mock_server --port 8000 --latency lognormal:-0.5,0.3 --throttle-rate 0.05
+
+``--capacity`` emulates a provisioned endpoint with that many replicas: extra
+requests queue (and see their latency grow) up to ``--max-queue``, beyond
+which they are rejected with 429 and ``Retry-After``.
+
+The server is a bare asyncio HTTP/1.1 implementation with keep-alive so that
+it can serve thousands of requests per second and never becomes the
+bottleneck in a client benchmark.
+"""
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Parse a latency distribution such as ``fixed:0.5``, ``uniform:0.2,1``,
+    ``normal:1,0.2`` or ``lognormal:0,0.5`` into a sampler in seconds."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda: values[0] if values else 0.0
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+@lru_cache(maxsize=32)
+def placeholder_png(width: int, height: int, color: Tuple[int, int, int] = (0, 119, 182)) -> bytes:
+    """Return a solid colour RGB PNG of the given size."""
+    row = b"\x00" + bytes(color) * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(row * height, 6))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+@lru_cache(maxsize=32)
+def placeholder_base64(width: int, height: int) -> str:
+    return base64.b64encode(placeholder_png(width, height)).decode()
+
+
+@lru_cache(maxsize=128)
+def _predict_body(width: int, height: int, num_images: int) -> bytes:
+    image = placeholder_base64(width, height)
+    return json.dumps({"completion": {f"image_{i}": image for i in range(num_images)}}).encode()
+
+
+@lru_cache(maxsize=128)
+def _canny_body(width: int, height: int, num_images: int) -> bytes:
+    return json.dumps({"images": [placeholder_base64(width, height)] * num_images}).encode()
+
+
+class MockConfig:
+    """Behaviour of the mock server."""
+
+    def __init__(
+        self,
+        latency: str = "fixed:0",
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 1,
+        capacity: int = 0,
+        max_queue: int = 0,
+        image_latency: float = 0.0,
+    ):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        # Whole seconds, the delay-seconds form of Retry-After is an integer
+        self.retry_after = int(retry_after)
+        # Concurrent generations served, 0 for unlimited, and how many more may wait
+        self.capacity = capacity
+        self.max_queue = max_queue
+        # Extra seconds for each image of a request after the first
+        self.image_latency = image_latency
+
+
+class MockServer:
+    """Asyncio HTTP server emulating the OctoAI image endpoints."""
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = "127.0.0.1", port: int = 8000):
+        self.config = config or MockConfig()
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.generating = 0
+        self.rejected = 0
+        self._slots = None
+        self.responses = {}
+        self._response_ids = itertools.count()
+        self.routes = {
+            ("GET", "/healthcheck"): self.healthcheck,
+            ("POST", "/predict"): self.predict,
+            ("POST", "/canny"): self.canny,
+        }
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def healthcheck(self, body: Dict, headers: Dict):
+        return 200, {}, b'{"status": "healthy"}'
+
+    async def _generate(self, body: Dict, num_images_key: str, render: Callable):
+        config = self.config
+        if not config.capacity:
+            return await self._render(body, num_images_key, render, 0.0)
+        # Beyond capacity requests wait for a replica, and beyond the queue they are throttled
+        if self.generating >= config.capacity + config.max_queue:
+            self.rejected += 1
+            return 429, {"Retry-After": str(config.retry_after)}, b'{"error": "Too many requests"}'
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(config.capacity)
+        self.generating += 1
+        arrived = time.perf_counter()
+        try:
+            async with self._slots:
+                return await self._render(body, num_images_key, render, time.perf_counter() - arrived)
+        finally:
+            self.generating -= 1
+
+    async def _render(self, body: Dict, num_images_key: str, render: Callable, queued: float):
+        config = self.config
+        num_images = int(body.get(num_images_key, 1))
+        delay = config.latency() + config.image_latency * max(num_images - 1, 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if config.throttle_rate and random.random() < config.throttle_rate:
+            return 429, {"Retry-After": str(config.retry_after)}, b'{"error": "Too many requests"}'
+        if config.error_rate and random.random() < config.error_rate:
+            return 500, {}, b'{"error": "Injected error"}'
+        width = int(body.get("width", 1024))
+        height = int(body.get("height", 1024))
+        # Report the queue wait and generation time like a real server would
+        timing = f"queue;dur={queued * 1000:.1f}, inference;dur={delay * 1000:.1f}"
+        return 200, {"Server-Timing": timing}, render(width, height, num_images)
+
+    async def _dispatch(self, body: Dict, headers: Dict, num_images_key: str, render: Callable):
+        if "x-octoai-async" not in headers:
+            return await self._generate(body, num_images_key, render)
+        # Queue the job and hand back a poll URL straight away
+        response_id = str(next(self._response_ids))
+        self.responses[response_id] = None
+
+        async def run():
+            self.responses[response_id] = await self._generate(body, num_images_key, render)
+
+        asyncio.ensure_future(run())
+        base_url = f"http://{headers.get('host', f'{self.host}:{self.port}')}"
+        reply = {"response_id": response_id, "status": "pending", "poll_url": f"{base_url}/responses/{response_id}"}
+        return 202, {}, json.dumps(reply).encode()
+
+    async def predict(self, body: Dict, headers: Dict):
+        return await self._dispatch(body, headers, "num_images", _predict_body)
+
+    async def canny(self, body: Dict, headers: Dict):
+        if "image" not in body:
+            return 400, {}, b'{"error": "Missing control image"}'
+        return await self._dispatch(body, headers, "num_images_per_prompt", _canny_body)
+
+    async def poll(self, path: str, headers: Dict):
+        # GET /responses/<id> reports status, /responses/<id>/result returns the body
+        parts = path.strip("/").split("/")
+        response_id = parts[1] if len(parts) > 1 else None
+        if response_id not in self.responses:
+            return 404, {}, b'{"error": "Unknown response id"}'
+        result = self.responses[response_id]
+        if len(parts) == 3 and parts[2] == "result":
+            if result is None:
+                return 404, {}, b'{"error": "Response not ready"}'
+            return self.responses.pop(response_id)
+        if result is None:
+            return 200, {}, json.dumps({"response_id": response_id, "status": "pending"}).encode()
+        if result[0] != 200:
+            del self.responses[response_id]
+            reply = {"response_id": response_id, "status": "failed", "error": result[2].decode()}
+            return 200, {}, json.dumps(reply).encode()
+        base_url = f"http://{headers.get('host', f'{self.host}:{self.port}')}"
+        reply = {"response_id": response_id, "status": "completed", "response_url": f"{base_url}/responses/{response_id}/result"}
+        return 200, {}, json.dumps(reply).encode()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+                self.requests += 1
+
+                path = target.split("?", 1)[0]
+                route = self.routes.get((method, path))
+                if method == "GET" and path.startswith("/responses/"):
+                    status, extra_headers, payload = await self.poll(path, headers)
+                elif route is None:
+                    status, extra_headers, payload = 404, {}, b'{"error": "Not found"}'
+                else:
+                    try:
+                        body = json.loads(raw) if raw else {}
+                    except ValueError:
+                        body = None
+                    if body is None:
+                        status, extra_headers, payload = 400, {}, b'{"error": "Invalid JSON"}'
+                    else:
+                        status, extra_headers, payload = await route(body, headers)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                response_headers = {
+                    "Content-Type": "application/json",
+                    "Content-Length": str(len(payload)),
+                    "Connection": "keep-alive" if keep_alive else "close",
+                    **extra_headers,
+                }
+                head = f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n" + "".join(
+                    f"{name}: {value}\r\n" for name, value in response_headers.items()
+                )
+                writer.write(head.encode("latin-1") + b"\r\n" + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        # Pick up the real port when bound to port 0
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, on_started: Optional[Callable[["MockServer"], None]] = None):
+        await self.start()
+        if on_started is not None:
+            on_started(self)
+        async with self._server:
+            await self._server.serve_forever()
+
+
+def start_in_thread(config: Optional[MockConfig] = None, host: str = "127.0.0.1", port: int = 0) -> MockServer:
+    """Start a mock server on a background thread and return it once listening.
+
+    Binds a free port by default; stop it with ``server.stop()``.
+    """
+    server = MockServer(config, host, port)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+
+    def stop():
+        loop.call_soon_threadsafe(server._server.close)
+        loop.call_soon_threadsafe(loop.stop)
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    server.stop = stop
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local mock OctoAI image server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="fixed:0",
+                        help="fixed:S, uniform:LO,HI, normal:MEAN,STD or lognormal:MU,SIGMA (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests rejected with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--capacity", type=int, default=0, help="Concurrent generations served, 0 for unlimited")
+    parser.add_argument("--image-latency", type=float, default=0.0,
+                        help="Extra seconds per image after the first, GPUs batch images more cheaply than requests")
+    parser.add_argument("--max-queue", type=int, default=0, help="Requests that may wait beyond --capacity before 429s")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(args.latency, args.error_rate, args.throttle_rate, args.retry_after, args.capacity, args.max_queue, args.image_latency)
+    server = MockServer(config, args.host, args.port)
+    try:
+        # Announce the address once bound, with the port picked for --port 0
+        asyncio.run(server.serve_forever(lambda s: print(f"Mock OctoAI server listening on {s.url}", flush=True)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
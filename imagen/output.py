@@ -0,0 +1,177 @@
+"""Optional conversion of generated images, off the request path.
+
+The endpoints already return PNGs, so by default images are written exactly
+as decoded from the response (see ``imagen.stream``) and never opened again.
+``OutputStage`` converts them to WebP, JPEG or a size optimized PNG and
+embeds the payload that generated them, in a process pool so encoding never
+holds up the requests.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence
+
+# Output format -> (Pillow format, file suffix)
+FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg"), "png": ("PNG", ".png")}
+
+# Input images are base64 blobs, too large for metadata and recorded in the history anyway
+OMITTED_FIELDS = ("init_image", "image", "mask_image")
+
+# EXIF tag holding the payload in WebP and JPEG files
+IMAGE_DESCRIPTION = 0x010E
+
+
+def output_path(path: str, output_format: str) -> str:
+    """Return where ``path`` ends up once converted to ``output_format``."""
+    return os.path.splitext(path)[0] + FORMATS[output_format][1]
+
+
+def payload_metadata(payload: Dict) -> str:
+    """Return the JSON embedded in an image generated from ``payload``."""
+    return json.dumps({k: v for k, v in payload.items() if k not in OMITTED_FIELDS}, sort_keys=True)
+
+
+def convert_image(path: str, output_format: str, quality: int = 90, metadata: Optional[str] = None) -> str:
+    """Convert the image at ``path`` to ``output_format`` and return the new file.
+
+    ``quality`` applies to WebP (100 is lossless) and JPEG; PNGs are always
+    lossless and optimized for size instead. ``metadata`` is stored as the
+    ``parameters`` text chunk of a PNG or the EXIF image description of a
+    WebP or JPEG. The source is kept, the target is written atomically.
+    """
+    from PIL import Image
+
+    image_format, _ = FORMATS[output_format]
+    target = output_path(path, output_format)
+    tmp_path = f"{target}.tmp"
+    options = {}
+    with Image.open(path) as image:
+        if image_format == "PNG":
+            options["optimize"] = True
+            if metadata is not None:
+                from PIL.PngImagePlugin import PngInfo
+
+                info = PngInfo()
+                info.add_text("parameters", metadata)
+                options["pnginfo"] = info
+        else:
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            options["quality"] = quality
+            if image_format == "WEBP" and quality >= 100:
+                options["lossless"] = True
+            if metadata is not None:
+                exif = Image.Exif()
+                exif[IMAGE_DESCRIPTION] = metadata
+                options["exif"] = exif.tobytes()
+        image.save(tmp_path, format=image_format, **options)
+    os.replace(tmp_path, target)
+    return target
+
+
+class OutputStage:
+    """Convert images in a background process pool.
+
+    ``submit`` schedules the conversion of a job's images and returns a
+    future of their final paths: the converted file, or the source when its
+    conversion failed. Sources are kept until ``close()``, so other jobs can still
+    link them in the meantime, and are then removed unless ``keep_source``
+    is set. Without an ``output_format`` images stay as they are.
+    """
+
+    def __init__(
+        self,
+        output_format: Optional[str] = None,
+        quality: int = 90,
+        embed_metadata: bool = True,
+        keep_source: bool = False,
+        workers: Optional[int] = None,
+    ):
+        if output_format is not None and output_format not in FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(FORMATS)}")
+        self.output_format = output_format
+        self.quality = quality
+        self.embed_metadata = embed_metadata
+        self.keep_source = keep_source
+        self.workers = workers
+        self._executor = None
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+        self.converted = 0
+        self.failed = 0
+
+    def targets(self, files: Sequence[str]) -> List[str]:
+        """Return the final paths of ``files``."""
+        if self.output_format is None:
+            return list(files)
+        return [output_path(path, self.output_format) for path in files]
+
+    def submit(self, files: Sequence[str], payload: Optional[Dict] = None) -> Future:
+        """Schedule the conversion of ``files`` generated from ``payload``, see the class docstring."""
+        done = Future()
+        if self.output_format is None or not files:
+            done.set_result(list(files))
+            return done
+        metadata = payload_metadata(payload) if self.embed_metadata and payload is not None else None
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Spawn rather than fork, the request threads may hold locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            futures = [
+                self._executor.submit(convert_image, path, self.output_format, self.quality, metadata) for path in files
+            ]
+            self._pending.extend(zip(files, futures))
+
+        remaining = [len(futures)]
+
+        def converted(_):
+            # Runs on the pool's thread once per image, resolve when the last one is done
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            done.set_result([path if future.exception() else future.result() for path, future in zip(files, futures)])
+
+        for future in futures:
+            future.add_done_callback(converted)
+        return done
+
+    def wait(self) -> List[tuple]:
+        """Wait for every scheduled conversion and return ``(path, error)`` for the failed ones."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        failures = []
+        for path, future in pending:
+            try:
+                target = future.result()
+            except Exception as e:
+                failures.append((path, str(e)))
+                continue
+            if target != path and not self.keep_source:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self.converted += len(pending) - len(failures)
+            self.failed += len(failures)
+        return failures
+
+    def close(self) -> List[tuple]:
+        """Finish every conversion, remove the sources and stop the pool."""
+        failures = self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return failures
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"format": self.output_format, "converted": self.converted, "failed": self.failed, "pending": len(self._pending)}
@@ -0,0 +1,229 @@
+"""Client-side load balancing and failover across several deployments.
+
+``Router`` spreads requests over a pool of endpoints, e.g. the a10 and a100
+ControlNet deployments or the same model in several regions. Each request
+goes to the endpoint with the lowest score: ``least_outstanding`` divides
+the requests in flight by the endpoint's weight, ``ewma`` also multiplies by
+its smoothed latency so slow endpoints get less traffic. Every endpoint has
+its own ``AdaptiveLimiter``, so the pool serves the sum of what each member
+can, and a circuit breaker that takes an endpoint out of rotation after
+repeated failures and lets a single trial request through once ``cooldown``
+has passed. Failed, throttled and timed out requests are retried on another
+endpoint straight away.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import requests
+
+from imagen.limiter import DEFAULT_TIMEOUT, RETRY_STATUSES, AdaptiveLimiter, retry_after, retry_delay
+from imagen.session import DEFAULT_POOL_SIZE, get_session
+
+EWMA = "ewma"
+LEAST_OUTSTANDING = "least_outstanding"
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Endpoint:
+    """One deployment in a ``Router`` pool."""
+
+    def __init__(self, url: str, weight: float = 1.0, limiter: Optional[AdaptiveLimiter] = None):
+        self.url = url
+        self.weight = weight
+        self.limiter = limiter
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "latency": self.latency,
+            "requests": self.requests,
+            "errors": self.errors,
+            "limit": self.limiter.stats()["limit"] if self.limiter is not None else None,
+        }
+
+
+class Router:
+    """Pick an endpoint per request and fail over between them.
+
+    ``endpoints`` are URLs or ``(url, weight)`` pairs. With ``adaptive`` each
+    endpoint gets an ``AdaptiveLimiter`` of at most ``max_per_endpoint``
+    requests in flight.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[Union[str, Tuple[str, float]]],
+        token: Optional[str] = None,
+        policy: str = EWMA,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        smoothing: float = 0.3,
+        adaptive: bool = True,
+        max_per_endpoint: int = 64,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        http2: bool = False,
+    ):
+        if policy not in (EWMA, LEAST_OUTSTANDING):
+            raise ValueError(f"Unknown routing policy {policy!r}")
+        self.token = token
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.endpoints: List[Endpoint] = []
+        for endpoint in endpoints:
+            url, weight = (endpoint, 1.0) if isinstance(endpoint, str) else endpoint
+            limiter = AdaptiveLimiter(initial=min(4, max_per_endpoint), max_limit=max_per_endpoint) if adaptive else None
+            self.endpoints.append(Endpoint(url, weight, limiter))
+        if not self.endpoints:
+            raise ValueError("Router needs at least one endpoint")
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def _available(self, endpoint: Endpoint, now: float) -> bool:
+        if endpoint.state == OPEN and now - endpoint.opened_at >= self.cooldown:
+            endpoint.state = HALF_OPEN
+        if endpoint.state == HALF_OPEN:
+            # One trial request at a time while half open
+            return endpoint.outstanding == 0
+        return endpoint.state == CLOSED
+
+    def _score(self, endpoint: Endpoint) -> float:
+        load = (endpoint.outstanding + 1) / endpoint.weight
+        if self.policy == LEAST_OUTSTANDING:
+            return load
+        # Endpoints without a latency yet score zero so each one gets tried
+        return (endpoint.latency or 0.0) * load
+
+    def _next_wake(self, now: float) -> Optional[float]:
+        # When an open circuit or a Retry-After pause next ends, if ever
+        times = [e.opened_at + self.cooldown for e in self.endpoints if e.state == OPEN]
+        times += [e.limiter.resume_at for e in self.endpoints if e.limiter is not None and e.limiter.resume_at > now]
+        return min(times) - now if times else None
+
+    def acquire(self, exclude=(), timeout: Optional[float] = None) -> Optional[Endpoint]:
+        """Take a slot on the best endpoint not in ``exclude``.
+
+        Waits while every candidate is at its limit or every endpoint is
+        open. Returns None once ``timeout`` expires, or straight away if the
+        only available endpoints are excluded.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.time()
+                    available = [e for e in self.endpoints if self._available(e, now)]
+                    candidates = [e for e in available if e not in exclude]
+                    if available and not candidates:
+                        return None
+                    for endpoint in sorted(candidates, key=self._score):
+                        if endpoint.limiter is None or endpoint.limiter.acquire(timeout=0):
+                            endpoint.outstanding += 1
+                            endpoint.requests += 1
+                            return endpoint
+                    wait = self._next_wake(now)
+                    if deadline is not None:
+                        if now >= deadline:
+                            return None
+                        wait = min(wait if wait is not None else deadline - now, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self.waiting -= 1
+
+    def release(self, endpoint: Endpoint, latency: Optional[float] = None, status: Optional[int] = None, delay: Optional[float] = None):
+        """Return the slot and update latency and the circuit breaker.
+
+        ``status`` is None for requests that failed without a response.
+        Throttling (429) moves traffic elsewhere but doesn't trip the breaker.
+        """
+        with self._cond:
+            endpoint.outstanding -= 1
+            if endpoint.limiter is not None:
+                endpoint.limiter.release(latency, status, delay)
+            if status is not None and status < 500:
+                if status != 429:
+                    endpoint.failures = 0
+                    endpoint.state = CLOSED
+                    if latency is not None:
+                        if endpoint.latency is None:
+                            endpoint.latency = latency
+                        else:
+                            endpoint.latency += self.smoothing * (latency - endpoint.latency)
+            else:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.state == HALF_OPEN or endpoint.failures >= self.failure_threshold:
+                    endpoint.state = OPEN
+                    endpoint.opened_at = time.time()
+            self._cond.notify_all()
+
+    def send(self, method: str = "POST", max_retries: int = 5, backoff: float = 1.0, trace=None, **kwargs):
+        """Send a request to the pool, failing over on 429/5xx and connection errors.
+
+        A failed request is retried on an endpoint that hasn't been tried
+        yet; once every endpoint has been tried the router backs off before
+        starting over. Returns the last response, whose ``url`` is the
+        endpoint that served it. Other keyword arguments go to
+        ``session.request``; ``timeout`` defaults to ``DEFAULT_TIMEOUT`` so a
+        stalled endpoint counts as failed instead of holding its slot.
+        """
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        tried = set()
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            endpoint = self.acquire(exclude=tried)
+            if endpoint is None:
+                # Every available endpoint failed this request, back off and start over
+                delay = retry_delay(attempt, backoff)
+                if trace is not None:
+                    trace.add("retry_wait", delay)
+                time.sleep(delay)
+                tried.clear()
+                start = time.perf_counter()
+                endpoint = self.acquire()
+            if trace is not None:
+                trace.add("queue", time.perf_counter() - start)
+
+            session = get_session(self.token, endpoint.url, pool_size=self.pool_size, http2=self.http2)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, endpoint.url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                # No status: counts towards the circuit breaker like a 5xx
+                self.release(endpoint)
+                tried.add(endpoint)
+                if attempt == max_retries:
+                    raise
+                continue
+            latency = time.perf_counter() - start
+            self.release(endpoint, latency, response.status_code, retry_after(response))
+            if trace is not None:
+                trace.response(response, latency)
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+            response.close()
+            tried.add(endpoint)
+
+    def stats(self) -> List[Dict]:
+        with self._cond:
+            return [endpoint.stats() for endpoint in self.endpoints]
@@ -0,0 +1,238 @@
+"""Fair sharing of one deployment between the users of a shared app.
+
+``FairScheduler`` caps the generations in flight across the whole process
+and decides who goes next with start-time fair queueing: every request is
+tagged with a virtual start time, the later of the start tag last served and
+the user's previous finish tag, and its finish is the start plus its cost
+(its image count) divided by the user's weight. The waiting request with the lowest start tag goes first, so
+a user with a backlog of large jobs is served in proportion to their weight
+instead of in arrival order, and a user without a backlog goes next.
+
+Each user also gets a token bucket of images per minute and a cap on
+requests waiting, and ``interactive_slots`` of the concurrency are kept for
+interactive requests so they never wait behind a sweep.
+"""
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+
+class QuotaExceeded(RuntimeError):
+    """Raised when a user already has too many requests waiting."""
+
+
+class Ticket:
+    """A request waiting for, or holding, a slot."""
+
+    def __init__(self, user: str, cost: float, interactive: bool, start: float, finish: float, seq: int):
+        self.user = user
+        self.cost = cost
+        self.interactive = interactive
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.granted = False
+        self.enqueued_at = time.time()
+        self.granted_at = None
+
+    @property
+    def wait(self) -> float:
+        return (self.granted_at or time.time()) - self.enqueued_at
+
+
+class _User:
+    def __init__(self, tokens: float):
+        self.finish = 0.0
+        self.tokens = tokens
+        self.refilled_at = time.time()
+        self.in_flight = 0
+        self.waiting = 0
+        self.images = 0
+
+
+class FairScheduler:
+    """Weighted fair queueing of requests from many users onto a few slots.
+
+    ``weights`` maps users to their share, others get ``default_weight``.
+    ``images_per_minute`` refills each user's bucket of ``burst`` images;
+    None disables rate limiting.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 8,
+        interactive_slots: int = 1,
+        weights: Optional[Dict[str, float]] = None,
+        default_weight: float = 1.0,
+        images_per_minute: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_waiting: int = 64,
+    ):
+        self.max_in_flight = max_in_flight
+        self.interactive_slots = min(interactive_slots, max_in_flight - 1)
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self.images_per_minute = images_per_minute
+        self.burst = burst if burst is not None else (images_per_minute or 0)
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.batch_in_flight = 0
+        self.virtual_time = 0.0
+        self._users: Dict[str, _User] = {}
+        self._waiting: List[Ticket] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _user(self, user: str) -> _User:
+        state = self._users.get(user)
+        if state is None:
+            state = self._users[user] = _User(self.burst)
+        return state
+
+    def _refill(self, state: _User, now: float):
+        if self.images_per_minute is None:
+            return
+        state.tokens = min(state.tokens + (now - state.refilled_at) * self.images_per_minute / 60, self.burst)
+        state.refilled_at = now
+
+    def _eligible(self, ticket: Ticket, now: float) -> bool:
+        if not ticket.interactive and self.batch_in_flight >= self.max_in_flight - self.interactive_slots:
+            return False
+        if self.images_per_minute is None:
+            return True
+        state = self._users[ticket.user]
+        self._refill(state, now)
+        # Requests larger than the bucket go once it is full
+        return state.tokens >= min(ticket.cost, self.burst)
+
+    def _dispatch(self) -> Optional[float]:
+        # Grant slots in start tag order, return when a rate limited request may go
+        now = time.time()
+        retry_in = None
+        for ticket in sorted(self._waiting, key=lambda t: (t.start, t.seq)):
+            if self.in_flight >= self.max_in_flight:
+                break
+            if not self._eligible(ticket, now):
+                if self.images_per_minute:
+                    state = self._users[ticket.user]
+                    missing = min(ticket.cost, self.burst) - state.tokens
+                    if missing > 0:
+                        wait = missing * 60 / self.images_per_minute
+                        retry_in = wait if retry_in is None else min(retry_in, wait)
+                continue
+            self._waiting.remove(ticket)
+            state = self._users[ticket.user]
+            state.waiting -= 1
+            state.in_flight += 1
+            if self.images_per_minute is not None:
+                state.tokens -= min(ticket.cost, self.burst)
+            self.in_flight += 1
+            if not ticket.interactive:
+                self.batch_in_flight += 1
+            self.virtual_time = max(self.virtual_time, ticket.start)
+            ticket.granted = True
+            ticket.granted_at = now
+        self._cond.notify_all()
+        return retry_in
+
+    def _position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for t in self._waiting if (t.start, t.seq) < (ticket.start, ticket.seq))
+
+    def position(self, ticket: Ticket) -> int:
+        """How many requests go before ``ticket`` plus one, 0 once it runs."""
+        with self._cond:
+            return 0 if ticket.granted else self._position(ticket)
+
+    def _cancel(self, ticket: Ticket):
+        # Called with the lock held
+        if ticket.granted:
+            self.release(ticket, images=0)
+        elif ticket in self._waiting:
+            self._waiting.remove(ticket)
+            self._users[ticket.user].waiting -= 1
+            self._dispatch()
+
+    def acquire(
+        self,
+        user: str,
+        cost: float = 1.0,
+        interactive: bool = True,
+        timeout: Optional[float] = None,
+        on_wait: Optional[Callable[[int], None]] = None,
+    ) -> Optional[Ticket]:
+        """Wait for a slot for ``cost`` images, returning None on timeout.
+
+        ``on_wait(position)`` is called, without any lock held, whenever the
+        queue position changes. Raises ``QuotaExceeded`` if the user already
+        has ``max_waiting`` requests waiting.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            state = self._user(user)
+            if state.waiting >= self.max_waiting:
+                raise QuotaExceeded(f"{user} already has {state.waiting} requests waiting")
+            weight = self.weights.get(user, self.default_weight)
+            start = max(self.virtual_time, state.finish)
+            state.finish = start + cost / weight
+            ticket = Ticket(user, cost, interactive, start, state.finish, next(self._seq))
+            self._waiting.append(ticket)
+            state.waiting += 1
+        position = None
+        try:
+            while True:
+                with self._cond:
+                    retry_in = self._dispatch()
+                    if ticket.granted:
+                        return ticket
+                    now = time.time()
+                    if deadline is not None and now >= deadline:
+                        self._cancel(ticket)
+                        return None
+                    current = self._position(ticket)
+                    if on_wait is None or current == position:
+                        wait = retry_in
+                        if deadline is not None:
+                            wait = min(wait if wait is not None else deadline - now, deadline - now)
+                        self._cond.wait(wait)
+                        continue
+                position = current
+                on_wait(position)
+        except BaseException:
+            # E.g. the UI interrupting the wait, don't leave the ticket queued or its slot taken
+            with self._cond:
+                self._cancel(ticket)
+            raise
+
+    def release(self, ticket: Ticket, images: Optional[int] = None):
+        """Free the slot of ``ticket``, counting the ``images`` it produced."""
+        with self._cond:
+            state = self._users[ticket.user]
+            state.in_flight -= 1
+            state.images += ticket.cost if images is None else images
+            self.in_flight -= 1
+            if not ticket.interactive:
+                self.batch_in_flight -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user: str, cost: float = 1.0, interactive: bool = True, on_wait: Optional[Callable[[int], None]] = None):
+        """Hold a slot for the duration of a ``with`` block."""
+        ticket = self.acquire(user, cost, interactive, on_wait=on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiting),
+                "users": {
+                    user: {"in_flight": s.in_flight, "waiting": s.waiting, "images": s.images}
+                    for user, s in self._users.items()
+                },
+            }
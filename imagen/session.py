@@ -0,0 +1,120 @@
+"""Process-wide HTTP sessions shared by the app and the example scripts.
+
+Every call through a shared session reuses pooled keep-alive connections, so
+back-to-back generations skip the TCP and TLS handshakes. Sessions are cached
+per token and endpoint host. HTTP/2 is available through ``httpx`` when it is
+installed (``pip install httpx[http2]``).
+"""
+
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+_sessions: Dict[Tuple, object] = {}
+_lock = threading.Lock()
+
+
+def make_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """Create a keep-alive session with a connection pool of ``pool_size``."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class _HTTP2Response:
+    """Expose the parts of a ``requests`` response the clients use."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def text(self) -> str:
+        self._response.read()
+        return self._response.text
+
+    @property
+    def content(self) -> bytes:
+        return self._response.read()
+
+    def json(self):
+        self._response.read()
+        return self._response.json()
+
+    def iter_content(self, chunk_size: int = 64 * 1024):
+        return self._response.iter_bytes(chunk_size)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error for url {self._response.url}", response=self)
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Session:
+    """``requests``-style wrapper around an HTTP/2 ``httpx.Client``."""
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        import httpx
+
+        self._httpx = httpx
+        self.headers = {}
+        self.client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=None,
+        )
+
+    def request(self, method: str, url: str, headers=None, stream: bool = False, timeout=None, **kwargs):
+        headers = {**self.headers, **(headers or {})}
+        if "data" in kwargs:
+            kwargs["content"] = kwargs.pop("data")
+        if isinstance(timeout, tuple):
+            # requests-style (connect, read) timeout
+            connect, read = timeout
+            timeout = self._httpx.Timeout(read, connect=connect)
+        request = self.client.build_request(method, url, headers=headers, timeout=timeout, **kwargs)
+        try:
+            response = self.client.send(request, stream=stream)
+        except self._httpx.TimeoutException as e:
+            raise requests.Timeout(str(e)) from e
+        except self._httpx.TransportError as e:
+            raise requests.ConnectionError(str(e)) from e
+        return _HTTP2Response(response)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+
+def get_session(token: Optional[str] = None, endpoint: str = "", pool_size: int = DEFAULT_POOL_SIZE, http2: bool = False):
+    """Return the shared session for ``token`` and the host of ``endpoint``.
+
+    The session sends the bearer token and JSON content type by default.
+    """
+    parts = urlsplit(endpoint)
+    key = (token, parts.scheme, parts.netloc, pool_size, http2)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = HTTP2Session(pool_size) if http2 else make_session(pool_size)
+            session.headers.update({"Content-Type": "application/json"})
+            if token is not None:
+                session.headers.update({"Authorization": f"Bearer {token}"})
+            _sessions[key] = session
+        return session
@@ -0,0 +1,174 @@
+"""Batch runs sharded over worker processes and hosts.
+
+One process runs out of CPU on JSON parsing, base64 decoding and file writes
+long before the endpoints are saturated. The coordinator puts the jobs in a
+shared ``WorkQueue`` and starts worker processes, each with its own
+``BatchEngine``, session and limiter, that claim jobs from the queue a few at
+a time until none are left. Workers on other hosts join the same queue
+through a ``QueueServer``. Every worker reports its progress to the queue and
+the coordinator prints it per shard and in total. A worker's final report
+also carries its phase histograms, which ``run_shards`` returns for the
+coordinator to merge; per-trace JSON lines go to a file per worker.
+"""
+
+import multiprocessing
+import os
+import socket
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from imagen.workqueue import WorkQueue, open_queue
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def claim_jobs(queue: WorkQueue, worker: str, n: int) -> Iterator[Tuple[str, Dict]]:
+    """Yield jobs claimed ``n`` at a time until the queue runs dry."""
+    while True:
+        jobs = queue.claim(worker, n)
+        if not jobs:
+            return
+        yield from jobs
+
+
+def run_worker(queue_url: str, make_engine: Callable, engine_args, report_interval: float = 2.0) -> Dict:
+    """Run jobs from the queue at ``queue_url`` with ``make_engine(engine_args)``.
+
+    ``make_engine`` and ``engine_args`` must be picklable, the engine is
+    built in the worker process.
+    """
+    queue = open_queue(queue_url)
+    worker = worker_name()
+    engine = make_engine(engine_args)
+    if engine.tracer is not None and engine.tracer.jsonl_path is not None:
+        # One file per worker, processes appending to one file would interleave
+        root, ext = os.path.splitext(str(engine.tracer.jsonl_path))
+        engine.tracer.jsonl_path = f"{root}.{worker}{ext}"
+    start = time.time()
+    reported = 0.0
+
+    def report(done=False):
+        elapsed = time.time() - start
+        queue.report(worker, {
+            "completed": engine.completed,
+            "failed": engine.failed,
+            "images": engine.images,
+            "seconds": elapsed,
+            "images_per_minute": engine.images / elapsed * 60 if elapsed else 0.0,
+            "done": done,
+            # Histograms only once, they don't change the progress shown meanwhile
+            **({"trace": engine.tracer.snapshot()} if done and engine.tracer is not None else {}),
+        })
+
+    def on_result(result):
+        nonlocal reported
+        if "error" in result:
+            queue.fail(result["id"], worker, result["error"])
+        else:
+            queue.complete(result["id"], worker, result["files"], result["latency"])
+        if time.time() - reported >= report_interval:
+            report()
+            reported = time.time()
+
+    # Show up in the coordinator's progress right away
+    report()
+    # Claim a pool's worth at a time so shards finish close together, and
+    # go again while failed jobs come back to the queue for another attempt
+    while True:
+        finished = engine.completed + engine.failed
+        stats = engine.run(claim_jobs(queue, worker, engine.concurrency), on_result=on_result)
+        if engine.completed + engine.failed == finished:
+            break
+    if engine.output is not None:
+        engine.output.close()
+    report(done=True)
+    return stats
+
+
+def print_progress(progress: Dict, started_at: float):
+    jobs = progress["jobs"]
+    print(f"queue: {jobs['pending']} pending, {jobs['claimed']} claimed, {jobs['done']} done, {jobs['failed']} failed")
+    for worker, stats in progress["workers"].items():
+        if stats["updated_at"] < started_at:
+            continue
+        state = " (finished)" if stats["done"] else ""
+        print(
+            f"  {worker}: {stats['completed']} completed, {stats['failed']} failed, "
+            f"{stats['images_per_minute']:.1f} images/minute{state}"
+        )
+
+
+def run_shards(
+    queue: WorkQueue,
+    queue_url: str,
+    workers: int,
+    make_engine: Callable,
+    engine_args,
+    poll: float = 5.0,
+    drain: bool = False,
+    on_progress: Optional[Callable[[Dict, float], None]] = print_progress,
+) -> Dict:
+    """Run ``workers`` worker processes on ``queue`` until it is drained.
+
+    The workers open the queue at ``queue_url`` themselves. Progress of
+    every shard, including those on other hosts, goes to ``on_progress``
+    every ``poll`` seconds; ``traces`` of the result holds the phase
+    histograms of each shard that finished, see ``Tracer.merge``. With ``drain`` it returns only once no job is
+    pending or claimed, for when workers on other hosts share the queue, and
+    starts new workers for the jobs those workers drop. Returns the
+    aggregate statistics of the shards that ran during this call.
+    """
+    start = time.time()
+    # Spawn rather than fork, the coordinator may hold threads and an open database
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    try:
+        while True:
+            shards = [
+                context.Process(target=run_worker, args=(queue_url, make_engine, engine_args), daemon=True)
+                for _ in range(workers)
+            ]
+            for process in shards:
+                process.start()
+            processes += shards
+            while True:
+                for process in shards:
+                    process.join(timeout=poll / len(shards))
+                progress = queue.progress()
+                if on_progress is not None:
+                    on_progress(progress, start)
+                jobs = progress["jobs"]
+                if any(process.is_alive() for process in shards):
+                    continue
+                # Wait for the shards of other hosts, taking over jobs they dropped
+                if not drain or jobs["pending"] or not jobs["claimed"]:
+                    break
+                time.sleep(poll)
+            if not drain or not jobs["pending"]:
+                break
+        if drain:
+            # Let the other hosts send their final reports and read the final progress
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        # Claims of the killed workers go back to the queue on the next run
+        for process in processes:
+            process.terminate()
+        raise
+
+    elapsed = time.time() - start
+    progress = queue.progress()
+    shards = {worker: stats for worker, stats in progress["workers"].items() if stats["updated_at"] >= start}
+    images = sum(stats["images"] for stats in shards.values())
+    return {
+        "completed": sum(stats["completed"] for stats in shards.values()),
+        "failed": sum(stats["failed"] for stats in shards.values()),
+        "images": images,
+        "seconds": elapsed,
+        "images_per_minute": images / elapsed * 60 if elapsed else 0.0,
+        "shards": shards,
+        "jobs": progress["jobs"],
+        "traces": [stats["trace"] for stats in shards.values() if "trace" in stats],
+        "crashed": sum(1 for process in processes if process.exitcode != 0),
+    }
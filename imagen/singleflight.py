@@ -0,0 +1,127 @@
+"""Coalescing of identical generations.
+
+With a fixed ``seed`` identical payloads generate identical images, so when
+several users (or repeated batch rows) ask for the same generation at once
+only one request needs to reach the GPU. ``Coalescer`` keys every call on
+the canonical payload without its image count: a call joins an in-flight
+one producing at least as many images, and reuses the files of a finished
+one that produced at least as many, taking the first ``num_images`` of them.
+That assumes image ``i`` of a seeded batch doesn't depend on the batch size,
+as when the batch latents are drawn one after another from the seeded
+generator; pass ``prefix_reuse=False`` to only share exact matches.
+Payloads without a seed are never coalesced.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from imagen.cache import payload_key
+
+# Finished generations remembered for reuse
+MAX_FINISHED = 1024
+
+
+def variant_key(payload: Dict, endpoint: str = "", num_images_key: str = "num_images") -> Tuple[str, int]:
+    """Return the key of ``payload`` ignoring its image count, and the count."""
+    rest = {k: v for k, v in payload.items() if k != num_images_key}
+    return payload_key(rest, endpoint), int(payload.get(num_images_key, 1))
+
+
+class _Call:
+    def __init__(self, num_images: int):
+        self.num_images = num_images
+        self.files = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Coalescer:
+    """Share in-flight and finished generations between identical requests."""
+
+    def __init__(self, num_images_key: str = "num_images", prefix_reuse: bool = True, max_finished: int = MAX_FINISHED):
+        self.num_images_key = num_images_key
+        self.prefix_reuse = prefix_reuse
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, List[_Call]] = {}
+        self._finished: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.generated = 0
+        self.joined = 0
+        self.reused = 0
+
+    def _reuse(self, key: str, num_images: int) -> Optional[List[str]]:
+        files = self._finished.get(key)
+        if files is None or len(files) < num_images:
+            return None
+        if not all(os.path.exists(f) for f in files[:num_images]):
+            del self._finished[key]
+            return None
+        self._finished.move_to_end(key)
+        return files[:num_images]
+
+    def _remember(self, key: str, files: List[str]):
+        # Keep whichever finished call produced the most images
+        if len(files) >= len(self._finished.get(key, ())):
+            self._finished[key] = list(files)
+        self._finished.move_to_end(key)
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
+
+    def run(self, payload: Dict, endpoint: str, generate: Callable[[Dict], Optional[List[str]]]) -> Tuple[Optional[List[str]], bool]:
+        """Return the files for ``payload`` and whether they were shared.
+
+        ``generate(payload)`` runs the request and returns its image files, or
+        None if nothing was generated. Shared files belong to another call,
+        so callers that need files of their own should copy them.
+        """
+        if "seed" not in payload:
+            return generate(payload), False
+        key, num_images = variant_key(payload, endpoint, self.num_images_key)
+        if not self.prefix_reuse:
+            key = payload_key(payload, endpoint)
+        with self._lock:
+            files = self._reuse(key, num_images)
+            if files is not None:
+                self.reused += 1
+                return files, True
+            call = next((c for c in self._in_flight.get(key, []) if c.num_images >= num_images), None)
+            leader = call is None
+            if leader:
+                call = _Call(num_images)
+                self._in_flight.setdefault(key, []).append(call)
+            else:
+                self.joined += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return (call.files[:num_images] if call.files is not None else None), True
+
+        try:
+            call.files = generate(payload)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                calls = self._in_flight[key]
+                calls.remove(call)
+                if not calls:
+                    del self._in_flight[key]
+                if call.files:
+                    self.generated += 1
+                    self._remember(key, call.files)
+            call.done.set()
+        return call.files, False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "generated": self.generated,
+                "joined": self.joined,
+                "reused": self.reused,
+                "in_flight": sum(len(calls) for calls in self._in_flight.values()),
+            }
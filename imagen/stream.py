@@ -0,0 +1,311 @@
+"""Streaming decode of image responses straight to disk.
+
+The endpoints return images as base64 strings inside a JSON document. Rather
+than loading the whole body, decoding every image into memory and writing it
+out, the parser here walks the JSON incrementally and pipes each image string
+through a base64 decoder into its output file. Everything else in the response
+is collected into a small metadata dict where each image is replaced by the
+path it was written to.
+"""
+
+import base64
+import codecs
+import json
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# Size of the chunks read from the socket
+CHUNK_SIZE = 64 * 1024
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_WHITESPACE = " \t\r\n"
+_DELIMITERS = ",]}" + _WHITESPACE
+
+# Parser states
+_VALUE, _VALUE_OR_END, _KEY_OR_END, _KEY, _COLON, _AFTER_VALUE = range(6)
+
+
+class Base64FileSink:
+    """Incrementally decode base64 text into a file.
+
+    The image is written to ``<path>.tmp`` and renamed into place on
+    ``close()``, so ``path`` never holds a partial image. ``trace``
+    optionally records the time spent decoding and writing.
+    """
+
+    def __init__(self, path: str, trace=None):
+        self.path = path
+        self.trace = trace
+        self.tmp_path = f"{path}.tmp"
+        self._file = open(self.tmp_path, "wb")
+        self._pending = ""
+        self.bytes_written = 0
+
+    def write(self, text: str):
+        text = self._pending + text.replace("\n", "").replace("\r", "")
+        aligned = len(text) - len(text) % 4
+        self._pending = text[aligned:]
+        if aligned:
+            if self.trace is None:
+                data = base64.b64decode(text[:aligned])
+                self._file.write(data)
+            else:
+                start = time.perf_counter()
+                data = base64.b64decode(text[:aligned])
+                decoded = time.perf_counter()
+                self._file.write(data)
+                self.trace.add("decode", decoded - start)
+                self.trace.add("write", time.perf_counter() - decoded)
+            self.bytes_written += len(data)
+
+    def close(self):
+        if self._pending:
+            data = base64.b64decode(self._pending + "=" * (-len(self._pending) % 4))
+            self._file.write(data)
+            self.bytes_written += len(data)
+            self._pending = ""
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Drop the partial image, if it wasn't closed yet."""
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class StreamingJSONParser:
+    """Incremental JSON parser that can divert string values to file sinks.
+
+    ``sink_for(path)`` is called with the JSON path of every string value,
+    e.g. ``("completion", "image_0")`` or ``("images", 0)``. If it returns a
+    sink, the string is written to it chunk by chunk and the sink path is
+    stored in the result instead of the string.
+    """
+
+    def __init__(self, sink_for: Callable[[Tuple], Optional[Base64FileSink]]):
+        self.sink_for = sink_for
+        self.result = None
+        self.sinks = []
+        self._buf = ""
+        self._stack = []  # [container, key] pairs for the open containers
+        self._state = _VALUE
+        self._string = None  # parts of the string being read, or a sink
+        self._string_is_key = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._done = False
+
+    def _path(self) -> Tuple:
+        return tuple(key for _, key in self._stack)
+
+    def _emit(self, value):
+        # Attach a completed value to its parent container
+        if not self._stack:
+            self.result = value
+            self._done = True
+            self._state = _AFTER_VALUE
+            return
+        container, key = self._stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+            self._stack[-1][1] = key + 1
+        else:
+            container[key] = value
+        self._state = _AFTER_VALUE
+
+    def _open(self, container):
+        self._stack.append([container, 0 if isinstance(container, list) else None])
+        self._state = _VALUE_OR_END if isinstance(container, list) else _KEY_OR_END
+
+    def _close(self):
+        container, _ = self._stack.pop()
+        self._emit(container)
+
+    def _start_string(self, is_key: bool):
+        self._string_is_key = is_key
+        sink = None if is_key else self.sink_for(self._path())
+        if sink is not None:
+            self.sinks.append(sink)
+            self._string = sink
+        else:
+            self._string = []
+
+    def _string_write(self, text: str):
+        if isinstance(self._string, list):
+            self._string.append(text)
+        else:
+            self._string.write(text)
+
+    def _end_string(self):
+        if isinstance(self._string, list):
+            value = "".join(self._string)
+        else:
+            self._string.close()
+            value = self._string.path
+        self._string = None
+        if self._string_is_key:
+            self._stack[-1][1] = value
+            self._state = _COLON
+        else:
+            self._emit(value)
+
+    def feed(self, data: bytes):
+        self._buf += self._decoder.decode(data)
+        self._parse()
+
+    def close(self) -> Dict:
+        self._buf += self._decoder.decode(b"", final=True)
+        self._parse(final=True)
+        if not self._done or self._stack or self._string is not None:
+            raise ValueError("Incomplete JSON document")
+        return self.result
+
+    def _parse(self, final: bool = False):
+        buf = self._buf
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            if self._string is not None:
+                # Copy everything up to the next quote or escape in one go
+                quote = buf.find('"', pos)
+                escape = buf.find("\\", pos, quote if quote >= 0 else end)
+                if escape >= 0:
+                    self._string_write(buf[pos:escape])
+                    if escape + 1 >= end:
+                        pos = escape
+                        break
+                    char = buf[escape + 1]
+                    if char == "u":
+                        if escape + 6 > end:
+                            pos = escape
+                            break
+                        self._string_write(chr(int(buf[escape + 2:escape + 6], 16)))
+                        pos = escape + 6
+                    else:
+                        self._string_write(_ESCAPES[char])
+                        pos = escape + 2
+                elif quote >= 0:
+                    self._string_write(buf[pos:quote])
+                    pos = quote + 1
+                    self._end_string()
+                else:
+                    self._string_write(buf[pos:])
+                    pos = end
+                continue
+
+            char = buf[pos]
+            if char in _WHITESPACE:
+                pos += 1
+                continue
+            state = self._state
+            if state in (_VALUE, _VALUE_OR_END):
+                if char == "]" and state == _VALUE_OR_END:
+                    pos += 1
+                    self._close()
+                elif char == "{":
+                    pos += 1
+                    self._open({})
+                elif char == "[":
+                    pos += 1
+                    self._open([])
+                elif char == '"':
+                    pos += 1
+                    self._start_string(is_key=False)
+                else:
+                    # Scalar literal: number, true, false or null
+                    literal_end = pos
+                    while literal_end < end and buf[literal_end] not in _DELIMITERS:
+                        literal_end += 1
+                    if literal_end == end and not final:
+                        break
+                    self._emit(json.loads(buf[pos:literal_end]))
+                    pos = literal_end
+            elif state in (_KEY, _KEY_OR_END):
+                if char == "}" and state == _KEY_OR_END:
+                    pos += 1
+                    self._close()
+                elif char == '"':
+                    pos += 1
+                    self._start_string(is_key=True)
+                else:
+                    raise ValueError(f"Expected object key, got {char!r}")
+            elif state == _COLON:
+                if char != ":":
+                    raise ValueError(f"Expected ':', got {char!r}")
+                pos += 1
+                self._state = _VALUE
+            else:
+                if not self._stack:
+                    raise ValueError(f"Unexpected data after JSON document: {char!r}")
+                container = self._stack[-1][0]
+                pos += 1
+                if char == ",":
+                    self._state = _VALUE if isinstance(container, list) else _KEY
+                elif char == "]" and isinstance(container, list):
+                    self._close()
+                elif char == "}" and isinstance(container, dict):
+                    self._close()
+                else:
+                    raise ValueError(f"Unexpected {char!r} in JSON document")
+        self._buf = buf[pos:]
+
+
+def image_field_index(path: Tuple) -> Optional[int]:
+    """Return the image index for a JSON path holding an image, if any.
+
+    Handles both ``completion.image_N`` (SDXL) and ``images[N]`` (ControlNet).
+    """
+    if len(path) == 2 and path[0] == "completion" and str(path[1]).startswith("image_"):
+        return int(path[1][len("image_"):])
+    if len(path) == 2 and path[0] == "images" and isinstance(path[1], int):
+        return path[1]
+    return None
+
+
+def stream_to_files(response, image_path: Callable[[int], str], chunk_size: int = CHUNK_SIZE, trace=None) -> Dict:
+    """Stream an image response to disk and return its metadata.
+
+    ``response`` is a ``requests`` response opened with ``stream=True`` and
+    ``image_path(i)`` gives the output file for image ``i``. The returned dict
+    mirrors the response body with each image replaced by its file path.
+    ``trace`` optionally records the download, decode and write times.
+    """
+
+    def sink_for(path):
+        index = image_field_index(path)
+        return None if index is None else Base64FileSink(image_path(index), trace)
+
+    parser = StreamingJSONParser(sink_for)
+    try:
+        chunks = response.iter_content(chunk_size=chunk_size)
+        if trace is None:
+            for chunk in chunks:
+                parser.feed(chunk)
+        else:
+            # Time spent waiting on the socket, the decode and write times come from the sinks
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                trace.add("download", time.perf_counter() - start)
+                if chunk is None:
+                    break
+                parser.feed(chunk)
+        return parser.close()
+    except BaseException:
+        # Leave no partial images behind when the stream fails
+        for sink in parser.sinks:
+            sink.abort()
+        raise
+    finally:
+        response.close()
+
+
+def image_files(metadata: Dict) -> list:
+    """Return the image file paths recorded in streamed response metadata."""
+    if "completion" in metadata:
+        completion = metadata["completion"]
+        return [completion[k] for k in sorted(completion, key=lambda k: int(k[len("image_"):])) if k.startswith("image_")]
+    return list(metadata.get("images", []))
@@ -0,0 +1,117 @@
+"""Parameter sweeps: expand value lists into a grid of payloads and run them."""
+
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from imagen.cache import canonical_payload
+
+
+def _range(text: str):
+    start, stop, *step = (float(v) for v in text.split(":"))
+    step = step[0] if step else 1.0
+    if not all(math.isfinite(v) for v in (start, stop, step)):
+        raise ValueError("Range bounds and step must be finite")
+    if step <= 0:
+        raise ValueError("Range step must be positive")
+    return start, step, max(int(round((stop - start) / step)) + 1, 0)
+
+
+def count_values(text: str) -> int:
+    """Return how many values ``parse_values`` would give ``text``, without building them."""
+    text = text.strip()
+    if not text:
+        return 0
+    if ":" in text and "," not in text:
+        return _range(text)[2]
+    return sum(1 for v in text.split(",") if v.strip())
+
+
+def parse_values(text: str, cast: Callable = float, limit: Optional[int] = None) -> List:
+    """Parse ``"7, 9.5, 11"`` or an inclusive range ``"10:30:5"`` into values.
+
+    Raises ``ValueError`` on malformed input, and before building anything
+    when there are more than ``limit`` values.
+    """
+    text = text.strip()
+    if limit is not None and count_values(text) > limit:
+        raise ValueError(f"{count_values(text)} values, the limit is {limit}")
+    if not text:
+        return []
+    if ":" in text and "," not in text:
+        start, step, count = _range(text)
+        return [cast(round(start + i * step, 6)) for i in range(count)]
+    return [cast(v.strip()) for v in text.split(",") if v.strip()]
+
+
+def grid_size(axes: Dict[str, Sequence]) -> int:
+    """Return the number of combinations of ``axes``, before duplicates are dropped."""
+    return math.prod(len(values) for values in axes.values() if values)
+
+
+def _set(payload: Dict, field: str, value):
+    # Dotted fields address nested values, e.g. "loras.crayon-style"
+    *parents, name = field.split(".")
+    for parent in parents:
+        payload = payload.setdefault(parent, {})
+    payload[name] = value
+
+
+def expand(base: Dict, axes: Dict[str, Sequence], limit: Optional[int] = None) -> List[Tuple[Dict, Dict]]:
+    """Return ``(labels, payload)`` for every combination of ``axes`` values.
+
+    Axes without values are ignored and identical payloads are only returned
+    once. ``labels`` holds the swept values of each combination. Raises
+    ``ValueError`` before building anything when there are more than
+    ``limit`` combinations.
+    """
+    axes = {field: list(values) for field, values in axes.items() if values}
+    if limit is not None and grid_size(axes) > limit:
+        raise ValueError(f"Sweep expands to {grid_size(axes)} combinations, the limit is {limit}")
+    grid = []
+    seen = set()
+    for combination in itertools.product(*axes.values()):
+        labels = dict(zip(axes, combination))
+        payload = {k: (dict(v) if isinstance(v, dict) else v) for k, v in base.items()}
+        for field, value in labels.items():
+            _set(payload, field, value)
+        key = canonical_payload(payload)
+        if key in seen:
+            continue
+        seen.add(key)
+        grid.append((labels, payload))
+    return grid
+
+
+def label(labels: Dict) -> str:
+    return ", ".join(f"{field}={value}" for field, value in labels.items())
+
+
+def run_sweep(
+    grid: List[Tuple[Dict, Dict]],
+    run: Callable[[Dict], List[str]],
+    concurrency: int = 4,
+    lookup: Callable[[Dict], List[str]] = None,
+) -> Iterator[Tuple[int, List[str], Exception]]:
+    """Run every payload in ``grid`` and yield ``(index, files, error)`` as each finishes.
+
+    ``lookup`` returns already generated files for a payload, or None; those
+    combinations are yielded first without dispatching a request.
+    """
+    to_run = []
+    for index, (_, payload) in enumerate(grid):
+        files = lookup(payload) if lookup is not None else None
+        if files is not None:
+            yield index, files, None
+        else:
+            to_run.append(index)
+    if not to_run:
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run, grid[index][1]): index for index in to_run}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
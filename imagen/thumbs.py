@@ -0,0 +1,96 @@
+"""Thumbnail generation for displaying generated images.
+
+Full resolution PNGs are several MB each, so grids and previews show small
+WebP (or JPEG if Pillow lacks WebP support) thumbnails instead. Thumbnails
+are made once per image on a worker thread and stored next to the originals.
+"""
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+# Longest side of each thumbnail, in pixels
+THUMBNAIL_SIZES = (150, 300, 512)
+
+
+def _thumbnail_format() -> str:
+    from PIL import features
+
+    return "WEBP" if features.check("webp") else "JPEG"
+
+
+class ThumbnailPipeline:
+    """Generate and look up thumbnails of images in a background pool."""
+
+    def __init__(self, thumbs_dir, sizes: Sequence[int] = THUMBNAIL_SIZES, quality: int = 80, workers: int = 2):
+        self.thumbs_dir = Path(thumbs_dir)
+        self.thumbs_dir.mkdir(parents=True, exist_ok=True)
+        self.sizes = sorted(sizes, reverse=True)
+        self.quality = quality
+        self.format = _thumbnail_format()
+        self.suffix = ".webp" if self.format == "WEBP" else ".jpg"
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, image_path, size: int) -> Path:
+        return self.thumbs_dir / f"{Path(image_path).stem}_{size}{self.suffix}"
+
+    def _generate(self, image_path: str):
+        from PIL import Image
+
+        try:
+            with Image.open(image_path) as image:
+                image = image.convert("RGB")
+                # Shrink step by step from the largest size, each resize starts from a smaller image
+                for size in self.sizes:
+                    image.thumbnail((size, size))
+                    target = self.path_for(image_path, size)
+                    tmp_path = target.with_name(target.name + ".tmp")
+                    image.save(tmp_path, format=self.format, quality=self.quality)
+                    os.replace(tmp_path, target)
+        finally:
+            with self._lock:
+                self._pending.pop(image_path, None)
+
+    def submit(self, image_path) -> Optional[Future]:
+        """Schedule thumbnails for ``image_path`` unless they already exist."""
+        image_path = str(image_path)
+        with self._lock:
+            if image_path in self._pending:
+                return self._pending[image_path]
+            if all(self.path_for(image_path, size).exists() for size in self.sizes):
+                return None
+            future = self._executor.submit(self._generate, image_path)
+            self._pending[image_path] = future
+            return future
+
+    def get(self, image_path, size: int = 300, wait: float = 0.0) -> str:
+        """Return the thumbnail of ``image_path`` closest to ``size``.
+
+        Missing thumbnails are scheduled, waiting up to ``wait`` seconds for
+        them; the original is returned if they are not ready by then.
+        """
+        size = min(self.sizes, key=lambda s: (s < size, abs(s - size)))
+        target = self.path_for(image_path, size)
+        if target.exists():
+            return str(target)
+        future = self.submit(image_path)
+        if future is not None and wait:
+            try:
+                future.result(timeout=wait)
+            except TimeoutError:
+                pass
+            except Exception:
+                return str(image_path)
+        return str(target) if target.exists() else str(image_path)
+
+    def remove(self, image_path):
+        """Delete the thumbnails of ``image_path``."""
+        for size in self.sizes:
+            try:
+                os.remove(self.path_for(image_path, size))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,250 @@
+"""Per-request timing broken down by phase.
+
+A ``Trace`` records how long one generation spends in each phase, e.g.
+preparing the payload, waiting for its turn among users (``schedule``) and
+for a concurrency slot (``queue``), the request itself (connect, upload,
+server queue and inference), the download, base64 decode and writing the
+images. A ``Tracer`` aggregates finished traces into
+histograms per client and phase, appends them to a JSON lines file and
+renders them in the Prometheus text format.
+
+When the endpoint sends a ``Server-Timing`` header its entries are recorded
+as ``server_<name>`` phases and the rest of the request time as ``network``,
+which separates a slow GPU from a slow client or link.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Phases in the order they happen, used to order summaries
+PHASES = (
+    "prepare",
+    "schedule",
+    "queue",
+    "request",
+    "server_queue",
+    "server_inference",
+    "network",
+    "retry_wait",
+    "download",
+    "decode",
+    "write",
+    "record",
+    "total",
+)
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Recent samples kept per phase for percentiles
+RESERVOIR_SIZE = 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Return the ``q``-th percentile of ``values`` with linear interpolation."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def server_timing(response) -> Dict[str, float]:
+    """Parse a ``Server-Timing`` header into seconds per metric name."""
+    header = response.headers.get("Server-Timing") if response is not None else None
+    timings = {}
+    for metric in (header or "").split(","):
+        name, *params = (part.strip() for part in metric.split(";"))
+        for param in params:
+            key, _, value = param.partition("=")
+            if name and key == "dur":
+                try:
+                    timings[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+
+class Trace:
+    """Phase timings of one request."""
+
+    def __init__(self, tracer: Optional["Tracer"] = None, client: str = "", **attrs):
+        self.tracer = tracer
+        self.client = client
+        self.attrs = attrs
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.status = None
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] += seconds
+
+    @contextmanager
+    def phase(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.perf_counter() - start
+
+    def response(self, response, seconds: float):
+        """Record a request that took ``seconds`` until ``response`` headers arrived."""
+        self.add("request", seconds)
+        self.status = response.status_code
+        timings = server_timing(response)
+        for name, duration in timings.items():
+            self.add(f"server_{name}", duration)
+        if timings:
+            self.add("network", max(seconds - sum(timings.values()), 0.0))
+
+    def finish(self, status=None):
+        """Close the trace and hand it to the tracer."""
+        if "total" not in self.phases:
+            self.phases["total"] = time.perf_counter() - self._start
+        if status is not None:
+            self.status = status
+        if self.tracer is not None:
+            self.tracer.record(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish("error" if exc_type is not None else None)
+
+    def to_dict(self) -> Dict:
+        return {
+            "client": self.client,
+            "started_at": self.started_at,
+            "status": self.status,
+            "phases": dict(self.phases),
+            **self.attrs,
+        }
+
+
+class Tracer:
+    """Aggregate traces into histograms and export them.
+
+    ``jsonl_path`` appends one JSON line per finished trace. ``snapshot()``
+    and ``merge()`` carry the histograms of other processes into this one,
+    e.g. the shards of a batch into the coordinator.
+    """
+
+    def __init__(self, jsonl_path=None, buckets=BUCKETS):
+        self.jsonl_path = jsonl_path
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (client, phase) -> [bucket counts..., +Inf count], sum
+        self._counts: Dict = {}
+        self._sums: Dict = defaultdict(float)
+        self._recent: Dict = defaultdict(lambda: deque(maxlen=RESERVOIR_SIZE))
+        self.traces = 0
+
+    def trace(self, client: str, **attrs) -> Trace:
+        """Start a trace; use it as a context manager or call ``finish()``."""
+        return Trace(self, client, **attrs)
+
+    def record(self, trace: Trace):
+        with self._lock:
+            self.traces += 1
+            for phase, seconds in trace.phases.items():
+                key = (trace.client, phase)
+                counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        counts[i] += 1
+                        break
+                else:
+                    counts[-1] += 1
+                self._sums[key] += seconds
+                self._recent[key].append(seconds)
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "a") as f:
+                    f.write(json.dumps(trace.to_dict()) + "\n")
+
+    def snapshot(self) -> Dict:
+        """Return the histograms as JSON serializable data for ``merge``."""
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "traces": self.traces,
+                "phases": [
+                    [client, phase, counts, self._sums[(client, phase)], list(self._recent[(client, phase)])]
+                    for (client, phase), counts in self._counts.items()
+                ],
+            }
+
+    def merge(self, snapshot: Dict):
+        """Add the histograms of another tracer's ``snapshot()``."""
+        if tuple(snapshot["buckets"]) != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        with self._lock:
+            self.traces += snapshot["traces"]
+            for client, phase, counts, total, recent in snapshot["phases"]:
+                key = (client, phase)
+                merged = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+                self._counts[key] = [a + b for a, b in zip(merged, counts)]
+                self._sums[key] += total
+                self._recent[key].extend(recent)
+
+    def summary(self, client: Optional[str] = None) -> List[Dict]:
+        """Return count, mean, p50 and p95 per phase, in phase order."""
+        with self._lock:
+            rows = []
+            for (trace_client, phase), counts in self._counts.items():
+                if client is not None and trace_client != client:
+                    continue
+                recent = list(self._recent[(trace_client, phase)])
+                count = sum(counts)
+                rows.append({
+                    "client": trace_client,
+                    "phase": phase,
+                    "count": count,
+                    "mean": self._sums[(trace_client, phase)] / count,
+                    "p50": percentile(recent, 50),
+                    "p95": percentile(recent, 95),
+                })
+        order = {phase: i for i, phase in enumerate(PHASES)}
+        return sorted(rows, key=lambda r: (r["client"], order.get(r["phase"], len(order)), r["phase"]))
+
+    def prometheus(self) -> str:
+        """Render the histograms in the Prometheus text exposition format."""
+        name = "octoai_request_phase_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each phase of an image generation request.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            for (client, phase), counts in sorted(self._counts.items()):
+                labels = f'client="{client}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                cumulative += counts[-1]
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {self._sums[(client, phase)]:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the metrics atomically, e.g. for the node_exporter textfile collector."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def print_summary(self, client: Optional[str] = None):
+        for row in self.summary(client):
+            print(
+                f"{row['client']:>8} {row['phase']:<17} n={row['count']:<5} "
+                f"mean={row['mean'] * 1000:8.1f}ms p50={row['p50'] * 1000:8.1f}ms p95={row['p95'] * 1000:8.1f}ms"
+            )
@@ -0,0 +1,235 @@
+"""Client-side validation of SDXL requests against the documented API schema.
+
+The rules come from ``octoml_sd_api_docs/sdxl-1_0.md``: the supported
+resolution table, the sampler list, the 77 token prompt limit (not counting
+prompt weighting syntax) and ``strength`` only applying to img2img requests
+with an ``init_image``. The docs only list some of the checkpoints and
+LoRAs, so other names are reported as warnings rather than rejected.
+Problems are caught locally instead of after a slow round trip, and the
+fixable ones (resolution, ``strength`` without ``init_image``, out of range
+numbers) can be snapped to the nearest valid request.
+"""
+
+import math
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from imagen.constants import CHECKPOINTS
+
+SUPPORTED_RESOLUTIONS = (
+    (1024, 1024),
+    (1152, 896),
+    (896, 1152),
+    (1216, 832),
+    (832, 1216),
+    (1344, 768),
+    (768, 1344),
+    (1536, 640),
+    (640, 1536),
+)
+
+DOCUMENTED_SAMPLERS = (
+    "PNDM",
+    "KLMS",
+    "DDIM",
+    "DDPM",
+    "K_EULER",
+    "K_EULER_ANCESTRAL",
+    "DPMSolverMultistep",
+    "K_DPMPP_2M",
+    "DPM++2MKarras",
+    "DPMSingle",
+    "HEUN",
+    "DPM_2",
+    "DPM2_ANCESTRAL",
+    "DPM++ SDE Karras",
+)
+
+KNOWN_MODELS = tuple(m for m in CHECKPOINTS if m != "default")
+KNOWN_LORAS = ("add-detail", "crayon-style", "paint-splash")
+
+MAX_PROMPT_TOKENS = 77
+MAX_NUM_IMAGES = 4
+
+# Numeric fields and their inclusive (min, max) range. The docs give no
+# bounds for cfg_scale, steps or seed, so those are left to the server
+RANGES = {
+    "num_images": (1, MAX_NUM_IMAGES),
+    "high_noise_frac": (0.0, 1.0),
+    "strength": (0.0, 1.0),
+}
+
+FIELDS = {
+    "prompt": str,
+    "prompt_2": str,
+    "negative_prompt": str,
+    "sampler": str,
+    "height": int,
+    "width": int,
+    "cfg_scale": (int, float),
+    "steps": int,
+    "num_images": int,
+    "seed": int,
+    "style_preset": str,
+    "use_refiner": bool,
+    "high_noise_frac": (int, float),
+    "model": str,
+    "loras": dict,
+    "init_image": str,
+    "strength": (int, float),
+}
+
+# Weighting syntax such as "(A tall (beautiful:1.5) woman:1.0)" doesn't count towards the limit
+_WEIGHT_RE = re.compile(r":\s*[-+]?\d*\.?\d+\s*(?=\))|[()]")
+# Approximates the CLIP tokenizer: one token per word or punctuation mark
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+class ValidationError(ValueError):
+    """Raised for requests the API would reject."""
+
+    def __init__(self, problems: List[str]):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def count_prompt_tokens(prompt: str) -> int:
+    """Approximate token count of ``prompt`` with weighting syntax stripped."""
+    return len(_TOKEN_RE.findall(_WEIGHT_RE.sub(" ", prompt)))
+
+
+def nearest_resolution(width: int, height: int) -> Tuple[int, int]:
+    """Return the supported resolution closest in aspect ratio, then area."""
+    aspect = math.log(width / height) if width > 0 and height > 0 else 0.0
+    area = width * height
+    return min(
+        SUPPORTED_RESOLUTIONS,
+        key=lambda r: (round(abs(math.log(r[0] / r[1]) - aspect), 3), abs(r[0] * r[1] - area)),
+    )
+
+
+class Validator:
+    """Validate and snap ``/predict`` payloads.
+
+    The lookup tables are built once so each check is a handful of set
+    lookups and comparisons. Checkpoints and LoRAs outside ``models`` and
+    ``loras`` are only reported by ``warnings()``, unless ``strict_names``
+    makes them problems too.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[str] = KNOWN_MODELS,
+        loras: Sequence[str] = KNOWN_LORAS,
+        samplers: Sequence[str] = DOCUMENTED_SAMPLERS,
+        max_prompt_tokens: int = MAX_PROMPT_TOKENS,
+        strict_names: bool = False,
+    ):
+        self.models = frozenset(models)
+        self.loras = frozenset(loras)
+        self.strict_names = strict_names
+        self.samplers = frozenset(samplers)
+        self.resolutions = frozenset(SUPPORTED_RESOLUTIONS)
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def check(self, payload: Dict) -> List[str]:
+        """Return a list of problems with ``payload``, empty when valid."""
+        problems = []
+        for field, value in payload.items():
+            expected = FIELDS.get(field)
+            if expected is None:
+                problems.append(f"unknown field {field!r}")
+            elif not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+                problems.append(f"{field} has invalid type {type(value).__name__}")
+        if problems:
+            return problems
+
+        if "prompt" not in payload:
+            problems.append("prompt is required")
+        for field in ("prompt", "prompt_2"):
+            if field in payload:
+                tokens = count_prompt_tokens(payload[field])
+                if tokens > self.max_prompt_tokens:
+                    problems.append(f"{field} has about {tokens} tokens, the limit is {self.max_prompt_tokens}")
+        resolution = (payload.get("width", 1024), payload.get("height", 1024))
+        if resolution not in self.resolutions:
+            problems.append(f"unsupported resolution {resolution[0]}x{resolution[1]}")
+        for field, (low, high) in RANGES.items():
+            if field in payload and not low <= payload[field] <= high:
+                problems.append(f"{field}={payload[field]} is outside [{low}, {high}]")
+        if "sampler" in payload and payload["sampler"] not in self.samplers:
+            problems.append(f"unknown sampler {payload['sampler']!r}")
+        if self.strict_names:
+            problems += self._unknown_names(payload)
+        if "strength" in payload and "init_image" not in payload:
+            problems.append("strength only applies with an init_image")
+        return problems
+
+    def _unknown_names(self, payload: Dict) -> List[str]:
+        unknown = []
+        if isinstance(payload.get("model"), str) and payload["model"] not in self.models:
+            unknown.append(f"unknown model {payload['model']!r}")
+        if isinstance(payload.get("loras"), dict):
+            unknown += [f"unknown LoRA {name!r}" for name in payload["loras"] if name not in self.loras]
+        return unknown
+
+    def warnings(self, payload: Dict) -> List[str]:
+        """Return checkpoints and LoRAs of ``payload`` missing from the known lists."""
+        return [] if self.strict_names else self._unknown_names(payload)
+
+    def validate(self, payload: Dict) -> Dict:
+        """Return ``payload`` unchanged or raise ``ValidationError``."""
+        problems = self.check(payload)
+        if problems:
+            raise ValidationError(problems)
+        return payload
+
+    def snap(self, payload: Dict) -> Tuple[Dict, List[str]]:
+        """Fix what can be fixed and validate the rest.
+
+        Returns the snapped payload and a description of each change. Raises
+        ``ValidationError`` for problems that cannot be fixed automatically.
+        """
+        payload = dict(payload)
+        changes = []
+        width, height = payload.get("width", 1024), payload.get("height", 1024)
+        if isinstance(width, int) and isinstance(height, int) and (width, height) not in self.resolutions:
+            payload["width"], payload["height"] = nearest_resolution(width, height)
+            changes.append(f"resolution {width}x{height} -> {payload['width']}x{payload['height']}")
+        for field, (low, high) in RANGES.items():
+            value = payload.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and not low <= value <= high:
+                payload[field] = min(max(value, low), high)
+                changes.append(f"{field} {value} -> {payload[field]}")
+        if "strength" in payload and "init_image" not in payload:
+            del payload["strength"]
+            changes.append("dropped strength without init_image")
+        return self.validate(payload), changes
+
+
+def validate_jobs(
+    jobs: Iterable[Tuple[str, Dict]],
+    validator: Optional[Validator] = None,
+    snap: bool = False,
+    warnings: Optional[List] = None,
+):
+    """Validate every ``(job_id, payload)`` before any request is sent.
+
+    Returns the (possibly snapped) jobs and a list of ``(job_id, problems)``
+    for the invalid ones. ``warnings``, if given, collects the
+    ``(job_id, warnings)`` of valid jobs using unknown checkpoints or LoRAs.
+    """
+    validator = validator or Validator()
+    valid, errors = [], []
+    for job_id, payload in jobs:
+        try:
+            if snap:
+                payload, _ = validator.snap(payload)
+            else:
+                validator.validate(payload)
+            valid.append((job_id, payload))
+            if warnings is not None and validator.warnings(payload):
+                warnings.append((job_id, validator.warnings(payload)))
+        except ValidationError as e:
+            errors.append((job_id, e.problems))
+    return valid, errors
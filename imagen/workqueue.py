@@ -0,0 +1,339 @@
+"""Shared work queue for batch runs split over processes and hosts.
+
+Workers ``claim`` a few jobs at a time and report each one ``complete`` or
+``fail``. A claim is a lease: jobs whose worker died are handed out again
+once ``lease`` seconds pass without a result. Failed jobs are retried up to
+``max_attempts`` times. Workers also ``report`` their progress, which the
+coordinator reads back with ``progress()``.
+
+``SQLiteQueue`` is the default backend. It needs no server and is safe to
+share between the processes of one host. ``QueueServer`` serves any queue
+over HTTP so workers on other hosts can use it through ``HTTPQueue``; every
+call must carry the server's shared secret, which clients read from
+``IMAGEN_QUEUE_SECRET`` unless given one.
+``open_queue`` picks a backend from a URL; register others (e.g. a Redis or
+SQS queue implementing ``WorkQueue``) with ``register_backend``.
+"""
+
+import hmac
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+# Environment variable holding the secret shared by a QueueServer and its clients
+SECRET_ENV = "IMAGEN_QUEUE_SECRET"
+SECRET_HEADER = "X-Queue-Secret"
+
+
+class WorkQueue(ABC):
+    """Interface of a work queue backend."""
+
+    @abstractmethod
+    def unfinished(self, keys: Dict[str, str]) -> List[str]:
+        """Return the ids in ``keys`` (id -> payload hash) that still need to run.
+
+        That is every job not done with the same payload hash and not held
+        by a worker whose lease is still running, so re-adding them never
+        takes a job away from a live worker. Jobs an earlier run left
+        claimed count once their lease runs out.
+        """
+
+    @abstractmethod
+    def add(self, jobs: Iterable[Tuple[str, Dict, str]]) -> int:
+        """Queue ``(job_id, payload, key)`` jobs, resetting existing ids to pending."""
+
+    @abstractmethod
+    def claim(self, worker: str, n: int = 1) -> List[Tuple[str, Dict]]:
+        """Lease up to ``n`` jobs to ``worker``; an empty list means none are left."""
+
+    @abstractmethod
+    def complete(self, job_id: str, worker: str, files: List[str], latency: Optional[float] = None):
+        """Mark a job ``worker`` holds as done."""
+
+    @abstractmethod
+    def fail(self, job_id: str, worker: str, error: str):
+        """Record a failed attempt at a job ``worker`` holds."""
+
+    @abstractmethod
+    def report(self, worker: str, stats: Dict):
+        """Record the progress of ``worker``."""
+
+    @abstractmethod
+    def progress(self) -> Dict:
+        """Return job counts by status and the last report of each worker.
+
+        Jobs whose lease ran out count as pending.
+        """
+
+    @abstractmethod
+    def failures(self) -> List[Tuple[str, str]]:
+        """Return ``(job_id, error)`` for the jobs that ran out of attempts."""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_at REAL,
+    finished_at REAL,
+    files TEXT,
+    latency REAL,
+    error TEXT,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, seq);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    stats TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SQLiteQueue(WorkQueue):
+    """Work queue in an SQLite database shared by the processes of one host."""
+
+    def __init__(self, path, lease: float = 600.0, max_attempts: int = 3):
+        self.path = str(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Claims from several processes wait on each other's write locks
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def _write(self, fn: Callable):
+        # Run ``fn`` in one write transaction, taking the write lock up front
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def unfinished(self, keys: Dict[str, str]) -> List[str]:
+        with self._lock:
+            # Done jobs, and claims a worker may still be running
+            rows = dict(self._conn.execute(
+                "SELECT id, key FROM jobs WHERE status = ? OR (status = ? AND claimed_at >= ?)",
+                (DONE, CLAIMED, time.time() - self.lease),
+            ).fetchall())
+        return [job_id for job_id, key in keys.items() if rows.get(job_id) != key]
+
+    def add(self, jobs: Iterable[Tuple[str, Dict, str]]) -> int:
+        jobs = list(jobs)
+
+        def add(conn):
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM jobs").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO jobs (id, key, payload, status, seq) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET key = excluded.key, payload = excluded.payload, status = excluded.status, "
+                "worker = NULL, attempts = 0, claimed_at = NULL, finished_at = NULL, files = NULL, error = NULL",
+                [(job_id, key, json.dumps(payload), PENDING, seq + i + 1) for i, (job_id, payload, key) in enumerate(jobs)],
+            )
+            return len(jobs)
+
+        return self._write(add)
+
+    def claim(self, worker: str, n: int = 1) -> List[Tuple[str, Dict]]:
+        now = time.time()
+
+        def claim(conn):
+            rows = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = ? OR (status = ? AND claimed_at < ?) ORDER BY seq LIMIT ?",
+                (PENDING, CLAIMED, now - self.lease, n),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, worker = ?, claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                [(CLAIMED, worker, now, job_id) for job_id, _ in rows],
+            )
+            return [(job_id, json.loads(payload)) for job_id, payload in rows]
+
+        return self._write(claim)
+
+    def complete(self, job_id: str, worker: str, files: List[str], latency: Optional[float] = None):
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, files = ?, latency = ?, error = NULL WHERE id = ? AND worker = ?",
+            (DONE, time.time(), json.dumps(files), latency, job_id, worker),
+        ))
+
+    def fail(self, job_id: str, worker: str, error: str):
+        # Back to pending for another worker until the attempts run out
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, finished_at = ?, error = ? "
+            "WHERE id = ? AND worker = ?",
+            (self.max_attempts, FAILED, PENDING, time.time(), error, job_id, worker),
+        ))
+
+    def report(self, worker: str, stats: Dict):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO workers (worker, stats, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(worker) DO UPDATE SET stats = excluded.stats, updated_at = excluded.updated_at",
+            (worker, json.dumps(stats), time.time()),
+        ))
+
+    def progress(self) -> Dict:
+        with self._lock:
+            # Claims past their lease are up for grabs again
+            counts = dict(self._conn.execute(
+                "SELECT CASE WHEN status = ? AND claimed_at < ? THEN ? ELSE status END, COUNT(*) FROM jobs GROUP BY 1",
+                (CLAIMED, time.time() - self.lease, PENDING),
+            ).fetchall())
+            workers = self._conn.execute("SELECT worker, stats, updated_at FROM workers ORDER BY worker").fetchall()
+        return {
+            "jobs": {status: counts.get(status, 0) for status in (PENDING, CLAIMED, DONE, FAILED)},
+            "workers": {worker: {**json.loads(stats), "updated_at": updated_at} for worker, stats, updated_at in workers},
+        }
+
+    def failures(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self._conn.execute("SELECT id, error FROM jobs WHERE status = ? ORDER BY seq", (FAILED,)).fetchall()
+
+
+class QueueServer:
+    """Serve a ``WorkQueue`` to ``HTTPQueue`` clients on other hosts.
+
+    Every method is a ``POST /<method>`` with its keyword arguments as a
+    JSON object, answered with the JSON encoded return value. Requests
+    without ``secret`` in the ``X-Queue-Secret`` header are refused with a
+    403; without a ``secret`` a random one is made, read it from
+    ``server.secret``. Listens on loopback only unless ``host`` says
+    otherwise, e.g. ``0.0.0.0`` for workers on other hosts.
+    """
+
+    METHODS = ("unfinished", "add", "claim", "complete", "fail", "report", "progress", "failures")
+
+    def __init__(self, queue: WorkQueue, host: str = "127.0.0.1", port: int = 8765, secret: Optional[str] = None):
+        self.queue = queue
+        self.secret = secret or secrets.token_urlsafe(24)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                given = self.headers.get(SECRET_HEADER, "")
+                if not hmac.compare_digest(given.encode(), server.secret.encode()):
+                    self.send_error(403)
+                    return
+                method = self.path.strip("/")
+                if method not in server.METHODS:
+                    self.send_error(404)
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+                try:
+                    result = getattr(server.queue, method)(**json.loads(body or b"{}"))
+                    status, payload = 200, json.dumps(result)
+                except Exception as e:
+                    status, payload = 500, json.dumps({"error": str(e)})
+                data = payload.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        # A wildcard address isn't somewhere clients can connect to
+        if host in ("", "0.0.0.0", "::"):
+            host = socket.gethostname()
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+
+    def start(self) -> "QueueServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class HTTPQueue(WorkQueue):
+    """Client of a queue served by ``QueueServer``.
+
+    ``secret`` defaults to the ``IMAGEN_QUEUE_SECRET`` environment variable.
+    """
+
+    def __init__(self, url: str, timeout: float = 60.0, secret: Optional[str] = None):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+        secret = secret or os.environ.get(SECRET_ENV)
+        if secret:
+            self._session.headers[SECRET_HEADER] = secret
+
+    def _call(self, method: str, **kwargs):
+        response = self._session.post(f"{self.url}/{method}", json=kwargs, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Queue {method} failed with status code {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    def unfinished(self, keys):
+        return self._call("unfinished", keys=keys)
+
+    def add(self, jobs):
+        return self._call("add", jobs=[list(job) for job in jobs])
+
+    def claim(self, worker, n=1):
+        return [tuple(job) for job in self._call("claim", worker=worker, n=n)]
+
+    def complete(self, job_id, worker, files, latency=None):
+        self._call("complete", job_id=job_id, worker=worker, files=files, latency=latency)
+
+    def fail(self, job_id, worker, error):
+        self._call("fail", job_id=job_id, worker=worker, error=error)
+
+    def report(self, worker, stats):
+        self._call("report", worker=worker, stats=stats)
+
+    def progress(self):
+        return self._call("progress")
+
+    def failures(self):
+        return [tuple(failure) for failure in self._call("failures")]
+
+
+_BACKENDS: Dict[str, Callable[[str], WorkQueue]] = {
+    "sqlite": lambda url: SQLiteQueue(url[len("sqlite://"):]),
+    "http": HTTPQueue,
+    "https": HTTPQueue,
+}
+
+
+def register_backend(scheme: str, factory: Callable[[str], WorkQueue]):
+    """Make ``open_queue`` build ``scheme://...`` queues with ``factory(url)``."""
+    _BACKENDS[scheme] = factory
+
+
+def open_queue(url: str) -> WorkQueue:
+    """Open the queue at ``url``; plain paths are SQLite databases."""
+    scheme, sep, _ = url.partition("://")
+    if not sep:
+        return SQLiteQueue(url)
+    if scheme not in _BACKENDS:
+        raise ValueError(f"Unknown work queue backend {scheme!r}")
+    return _BACKENDS[scheme](url)
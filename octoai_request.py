@@ -1,7 +1,7 @@
-import requests
+import argparse
 import json
 import os
-import base64
+import time
 
 # Load token from environment variable or set it here
 OCTOAI_TOKEN = os.getenv("OCTOAI_TOKEN")
@@ -35,22 +35,263 @@ headers = {
     "Authorization": f"Bearer {OCTOAI_TOKEN}"
 }
 
-# Send the POST request
-response = requests.post(url, data=json.dumps(payload), headers=headers)
-
-# Check the response status code
-if response.status_code == 200:
-    blob = response.json()
-    image_base64 = blob["completion"]["image_0"]
-    image_data = base64.b64decode(image_base64)
-    
-    # Save the response to a JSON file
-    with open("octoai_response.json", "w") as outfile:
-        json.dump(blob, outfile)
-        
-    # Save base 64 image to a file
-    with open("octoai_example_image.png", "wb") as outfile:
-        outfile.write(image_data)
-else:
-    print(f"Request failed with status code: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+
+def single_request(url=url, http2=False, history_path="octoai_history.sqlite", tracer=None):
+    from imagen.history import History
+    from imagen.limiter import send
+    from imagen.session import get_session
+    from imagen.stream import image_files, stream_to_files
+    from imagen.tracing import Trace
+
+    # Time each phase of the request
+    with Trace(tracer, "script") as trace:
+        with trace.phase("prepare"):
+            body = json.dumps(payload)
+
+        # Send the POST request over the shared keep-alive session and stream the body,
+        # retrying on 429/5xx and honoring Retry-After
+        session = get_session(OCTOAI_TOKEN, url, http2=http2)
+        start = time.time()
+        response = send(session, url, data=body, headers=headers, stream=True, trace=trace)
+
+        # Check the response status code
+        if response.status_code == 200:
+            # Decode base 64 images straight into their files
+            metadata = stream_to_files(
+                response,
+                lambda i: "octoai_example_image.png" if i == 0 else f"octoai_example_image_{i}.png",
+                trace=trace,
+            )
+            
+            # Save the response metadata (image paths, no image data) to a JSON file
+            with open("octoai_response.json", "w") as outfile:
+                json.dump(metadata, outfile)
+            
+            # Record the generation so it can be searched and reproduced later
+            with trace.phase("record"):
+                History(history_path).record(payload, image_files(metadata), endpoint=url, latency=time.time() - start, source="script")
+        else:
+            print(f"Request failed with status code: {response.status_code}")
+            print(response.text)
+
+
+def prepare_jobs(jobs, args):
+    from imagen.images import prepare_images
+    from imagen.validation import nearest_resolution, validate_jobs
+
+    # Resize and compress local init images in a process pool
+    with_files = [job for _, job in jobs if "init_image_file" in job]
+    if with_files:
+        encoded = prepare_images(
+            [job.pop("init_image_file") for job in with_files],
+            [nearest_resolution(job.get("width", 1024), job.get("height", 1024)) for job in with_files],
+        )
+        for job, init_image in zip(with_files, encoded):
+            job["init_image"] = init_image
+
+    # Validate the whole file before sending a single request
+    warnings = []
+    jobs, errors = validate_jobs(jobs, snap=args.snap, warnings=warnings)
+    # Names the docs don't list may still exist, mention each one once
+    for warning in sorted({w for _, job_warnings in warnings for w in job_warnings}):
+        print(f"Warning: {warning}, not in the documented lists")
+    if errors:
+        for job_id, problems in errors:
+            print(f"[{job_id}] invalid: {'; '.join(problems)}")
+        raise SystemExit(f"{len(errors)} invalid request(s), nothing was sent")
+    # Jobs with a seed are only batched with --merge-seeds
+    seeded = sum("seed" in job for _, job in jobs)
+    if args.batch_window > 0 and not args.merge_seeds and seeded:
+        print(f"Warning: --batch-window doesn't batch the {seeded} of {len(jobs)} job(s) with a seed, "
+              "add --merge-seeds or drop the seed to batch them")
+    return jobs
+
+
+def make_engine(args, tracer=None, manifest=None):
+    from imagen.batch import BatchEngine
+    from imagen.history import History
+    from imagen.output import OutputStage
+    from imagen.tracing import Tracer
+
+    # Spread the batch over every --url, failing over between them
+    router = None
+    if len(args.url) > 1:
+        from imagen.router import Router
+
+        weights = args.weights or [1.0] * len(args.url)
+        router = Router(
+            list(zip(args.url, weights)),
+            OCTOAI_TOKEN,
+            policy=args.policy,
+            adaptive=not args.fixed_concurrency,
+            max_per_endpoint=args.concurrency,
+            pool_size=args.concurrency,
+            http2=args.http2,
+        )
+
+    # Convert images off the request path, sharing the cores between the shards
+    output = None
+    if args.output_format:
+        workers = max(1, (os.cpu_count() or 1) // args.workers) if args.workers else None
+        output = OutputStage(args.output_format, args.quality, not args.no_metadata, args.keep_png, workers)
+
+    return BatchEngine(
+        args.url[0],
+        OCTOAI_TOKEN,
+        out_dir=args.out,
+        concurrency=args.concurrency,
+        max_retries=args.retries,
+        http2=args.http2,
+        history=History(args.history),
+        adaptive=not args.fixed_concurrency,
+        tracer=tracer if tracer is not None else Tracer(jsonl_path=args.trace),
+        router=router,
+        manifest=manifest,
+        batch_window=args.batch_window,
+        merge_seeds=args.merge_seeds,
+        output=output,
+    )
+
+
+def batch_request(args, tracer=None):
+    from imagen.batch import load_jobs
+    from imagen.manifest import Manifest
+
+    # Skip the jobs an earlier run of this batch already completed
+    manifest = Manifest(args.manifest or os.path.join(args.out, "manifest.jsonl"))
+    jobs = list(load_jobs(args.batch, payload))
+    total = len(jobs)
+    jobs = list(manifest.pending(jobs))
+    if len(jobs) < total:
+        print(f"Resuming: {total - len(jobs)} of {total} job(s) already completed")
+    jobs = prepare_jobs(jobs, args)
+    engine = make_engine(args, tracer, manifest)
+
+    # Print each result as soon as it lands on disk
+    def on_result(result):
+        if "error" in result:
+            print(f"[{result['id']}] failed: {result['error']}")
+        else:
+            shared = " (shared with an identical request)" if result["shared"] else ""
+            print(f"[{result['id']}] {len(result['files'])} image(s) in {result['latency']:.1f}s{shared}")
+
+    with manifest:
+        stats = engine.run(jobs, on_result=on_result)
+    if engine.output is not None:
+        for path, error in engine.output.close():
+            print(f"{path}: conversion failed: {error}")
+        stats["output"] = engine.output.stats()
+    print(f"{stats['completed']} completed ({stats['coalesced']} without a request of their own), {stats['failed']} failed, {stats['images_per_minute']:.1f} images/minute")
+    if "output" in stats:
+        print(f"Converted {stats['output']['converted']} image(s) to {stats['output']['format']}, {stats['output']['failed']} failed")
+    if "microbatch" in stats:
+        print(f"Micro-batching sent {stats['microbatch']['batched']} job(s) as {stats['microbatch']['requests']} request(s)")
+    if "limiter" in stats:
+        print(f"Settled at {stats['limiter']['limit']} requests in flight, {stats['limiter']['throttled']} throttled")
+    for endpoint in stats.get("endpoints", []):
+        print(f"{endpoint['url']}: {endpoint['requests']} requests, {endpoint['errors']} errors, circuit {endpoint['state']}")
+
+
+def sharded_request(args, tracer=None):
+    from imagen.cache import payload_key
+    from imagen.shard import run_shards
+    from imagen.workqueue import SECRET_ENV, QueueServer, open_queue
+
+    # Workers open the queue in their own processes, hand them the secret of --join
+    if args.queue_secret:
+        os.environ[SECRET_ENV] = args.queue_secret
+    # Workers on this host share the queue directly, others join over HTTP
+    queue_url = args.join or args.queue or os.path.join(args.out, "queue.sqlite")
+    queue = open_queue(queue_url)
+    if args.batch:
+        from imagen.batch import load_jobs
+
+        # Queue the jobs an earlier run didn't finish, keyed by their payload before preparation
+        jobs = list(load_jobs(args.batch, payload))
+        keys = {job_id: payload_key(job) for job_id, job in jobs}
+        todo = set(queue.unfinished(keys))
+        if len(todo) < len(jobs):
+            print(f"Resuming: {len(jobs) - len(todo)} of {len(jobs)} job(s) already completed or running")
+        jobs = prepare_jobs([(job_id, job) for job_id, job in jobs if job_id in todo], args)
+        queue.add((job_id, job, keys[job_id]) for job_id, job in jobs)
+    server = None
+    if args.serve_queue:
+        server = QueueServer(queue, args.queue_host, args.serve_queue, os.environ.get(SECRET_ENV)).start()
+        print(f"Serving the queue on {args.queue_host}, join with "
+              f"{SECRET_ENV}={server.secret} python octoai_request.py --join {server.url} --workers N")
+
+    stats = run_shards(queue, queue_url, args.workers, make_engine, args, drain=server is not None)
+    if server is not None:
+        server.stop()
+    # The shards traced the requests, summarize them here
+    if tracer is not None:
+        for snapshot in stats["traces"]:
+            tracer.merge(snapshot)
+    print(f"{stats['completed']} completed, {stats['failed']} failed attempts over {len(stats['shards'])} shard(s), {stats['images_per_minute']:.1f} images/minute")
+    for job_id, error in queue.failures():
+        print(f"[{job_id}] failed: {error}")
+    jobs = stats["jobs"]
+    if jobs["pending"] or jobs["claimed"] or jobs["failed"]:
+        print(f"Left in the queue: {jobs['pending']} pending, {jobs['claimed']} claimed, {jobs['failed']} failed")
+    if stats["crashed"]:
+        print(f"{stats['crashed']} worker(s) crashed, rerun to retry their jobs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate images with OctoAI SDXL")
+    parser.add_argument("--url", nargs="+", default=[url],
+                        help="Endpoint to send requests to, batches are balanced over several")
+    parser.add_argument("--weights", nargs="+", type=float, help="Relative capacity of each --url")
+    parser.add_argument("--policy", choices=["ewma", "least_outstanding"], default="ewma",
+                        help="How batches pick an endpoint: latency aware or fewest requests in flight")
+    parser.add_argument("--batch", help="JSONL file of prompts or payload overrides")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max requests in flight")
+    parser.add_argument("--fixed-concurrency", action="store_true",
+                        help="Always keep --concurrency requests in flight instead of adapting to latency and 429s")
+    parser.add_argument("--batch-window", type=float, default=0.0,
+                        help="Seconds to hold jobs so those differing only in num_images are sent as one request (0 disables); "
+                             "jobs with a seed, including the default payload's, are only batched with --merge-seeds")
+    parser.add_argument("--merge-seeds", action="store_true",
+                        help="With --batch-window, also merge jobs differing in seed; images are then variants, not reproducible by seed")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per request on 429/5xx")
+    parser.add_argument("--out", default="octoai_batch", help="Output directory for batch images")
+    parser.add_argument("--manifest", help="Record finished batch jobs here and skip them on restart (default: <out>/manifest.jsonl)")
+    parser.add_argument("--output-format", choices=["webp", "jpeg", "png"],
+                        help="Convert batch images in a background process pool (default: keep the PNGs the server sent)")
+    parser.add_argument("--quality", type=int, default=90, help="WebP/JPEG quality of --output-format, 100 is lossless WebP")
+    parser.add_argument("--no-metadata", action="store_true", help="Don't embed the payload in images converted with --output-format")
+    parser.add_argument("--keep-png", action="store_true", help="Keep the PNGs the server sent next to the converted images")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run the batch in this many worker processes sharing a work queue (0 runs it in this process)")
+    parser.add_argument("--queue", help="Work queue of --workers: SQLite path or URL (default: <out>/queue.sqlite)")
+    parser.add_argument("--serve-queue", type=int, metavar="PORT", help="With --workers, let workers on other hosts join over HTTP")
+    parser.add_argument("--join", metavar="URL", help="Run --workers on the queue another host serves with --serve-queue")
+    parser.add_argument("--queue-host", default="127.0.0.1",
+                        help="Address --serve-queue listens on, e.g. 0.0.0.0 to let other hosts join (default: this host only)")
+    parser.add_argument("--queue-secret",
+                        help="Secret shared by --serve-queue and --join, also read from IMAGEN_QUEUE_SECRET (default: --serve-queue makes one)")
+    parser.add_argument("--snap", action="store_true", help="Snap resolutions and out of range values instead of failing")
+    parser.add_argument("--history", default="octoai_history.sqlite", help="SQLite file recording every generation")
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 (requires httpx[http2])")
+    parser.add_argument("--trace", help="Append per-request phase timings to this JSON lines file (one per worker with --workers)")
+    parser.add_argument("--metrics", help="Write phase histograms in Prometheus text format to this file")
+    args = parser.parse_args()
+    if args.weights and len(args.weights) != len(args.url):
+        parser.error("--weights needs one weight per --url")
+
+    from imagen.tracing import Tracer
+
+    tracer = Tracer(jsonl_path=args.trace)
+    if args.join and not args.workers:
+        parser.error("--join needs --workers")
+    if args.workers:
+        sharded_request(args, tracer)
+    elif args.batch:
+        batch_request(args, tracer)
+    else:
+        single_request(args.url[0], http2=args.http2, history_path=args.history, tracer=tracer)
+
+    # Where the time went, per phase
+    tracer.print_summary()
+    if args.metrics:
+        tracer.write_prometheus(args.metrics)